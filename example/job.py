@@ -1,6 +1,17 @@
+import argparse
 import time
 import numpy as np
 from mfl import Trainer, keras
+from mfl.simulation import SimulatedBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--simulate",
+    type=int,
+    default=0,
+    help="run on this many simulated phones instead of the Supabase project",
+)
+args = parser.parse_args()
 
 num_samples = 40000
 num_features = 10
@@ -22,12 +33,18 @@ model.compile(optimizer="sgd", loss="mean_squared_error")
 inputs = np.random.randint(1, 6, size=(num_samples, num_features)) 
 outputs = inputs * 2 + 1  
 
+backend = SimulatedBackend(num_devices=args.simulate) if args.simulate else None
+
 trainer = Trainer(
     model,
     inputs,
     outputs,
-    batch_size=batch_size)
+    batch_size=batch_size,
+    backend=backend)
 
 start = time.time()
 trainer.fit(epochs=epochs)
 print(f"Training took {time.time() - start:.2f} seconds")
+
+if backend is not None:
+    backend.shutdown()
@@ -0,0 +1,163 @@
+"""Benchmark cases, run by `run.py`.
+
+A case is a setup function registered with `@case(name, **grid)`. It is called
+with one value of each parameter of the grid, prepares its inputs, and returns
+the callable that is timed. Inputs are seeded so that every run measures the
+same work.
+"""
+
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+CASES: List[Dict[str, Any]] = []
+
+
+def case(name: str, **grid: List[Any]):
+    """Register a benchmark over the product of the values of `grid`"""
+
+    def register(setup: Callable[..., Callable[[], Any]]):
+        CASES.append({"name": name, "grid": grid, "setup": setup})
+        return setup
+
+    return register
+
+
+def _model(units: int, layers: int = 2):
+    """A dense model with `layers` layers of `units` x `units` weights"""
+    from mfl import keras
+
+    model = keras.Sequential(
+        [keras.layers.Input(shape=(units,))]
+        + [keras.layers.Dense(units) for _ in range(layers)]
+    )
+    model.compile(optimizer="sgd", loss="mean_squared_error")
+    return model
+
+
+def _weights(num_params: int, seed: int = 0) -> List[np.ndarray]:
+    """Float32 weights of about `num_params` values, as a kernel and a bias"""
+    rng = np.random.default_rng(seed)
+    rows = max(1, num_params // 100)
+    return [
+        rng.standard_normal((rows, 100), dtype=np.float32),
+        rng.standard_normal(100, dtype=np.float32),
+    ]
+
+
+@case("weights_round_trip", units=[64, 512], codec=["json", "binary"])
+def weights_round_trip(units: int, codec: str):
+    """Global weights out to a device payload and a response payload back in"""
+    from mfl import Trainer
+    from mfl.backend import InMemoryBackend
+
+    model = _model(units)
+    trainer = Trainer(
+        model,
+        np.zeros((1, units)),
+        np.zeros((1, units)),
+        batch_size=1,
+        codec=codec,
+        backend=InMemoryBackend(),
+    )
+
+    def round_trip():
+        payload = trainer.codec.encode_request({"weights": trainer._get_weights()})
+        response = trainer.codec.decode_response({"weights": payload["weights"]})
+        return trainer._deserialize_weights(response["weights"])
+
+    return round_trip
+
+
+@case("average_model_weights", clients=[10, 100, 1000], params=[1_000, 50_000])
+def average_model_weights(clients: int, params: int):
+    from mfl.federated import average_model_weights
+
+    updates = [_weights(params, seed) for seed in range(clients)]
+    return lambda: average_model_weights(updates)
+
+
+@case("fedavg_accumulator", clients=[10, 100, 1000], params=[1_000, 50_000])
+def fedavg_accumulator(clients: int, params: int):
+    """The streaming aggregation the trainer uses instead of averaging a list"""
+    from mfl.federated import FedAvgAccumulator
+
+    updates = [_weights(params, seed) for seed in range(clients)]
+
+    def accumulate():
+        accumulator = FedAvgAccumulator()
+        for update in updates:
+            accumulator.add(update, 10)
+        return accumulator.result()
+
+    return accumulate
+
+
+@case("split_datasets", samples=[100_000, 1_000_000], devices=[10, 1000])
+def split_datasets(samples: int, devices: int):
+    from mfl.data import split_datasets
+
+    rng = np.random.default_rng(0)
+    inputs = rng.random((samples, 32), dtype=np.float32)
+    outputs = rng.random((samples, 4), dtype=np.float32)
+    device_ids = list(range(devices))
+    return lambda: split_datasets(inputs, device_ids, outputs, include_outputs=True)
+
+
+@case("quantize_weights", params=[100_000, 10_000_000], dtype=["uint8", "uint16", "float16"])
+def quantize_weights(params: int, dtype: str):
+    from mfl.quantization import quantize_weights
+
+    data = _weights(params)[0]
+    return lambda: quantize_weights(data, np.dtype(dtype).type)
+
+
+@case("dequantize_weights", params=[100_000, 10_000_000], dtype=["uint8", "uint16", "float16"])
+def dequantize_weights(params: int, dtype: str):
+    from mfl.quantization import dequantize_weights, quantize_weights
+
+    quantized, metadata = quantize_weights(_weights(params)[0], np.dtype(dtype).type)
+    return lambda: dequantize_weights(quantized, metadata)
+
+
+@case("write_weights", params=[100_000, 4_000_000])
+def write_weights(params: int):
+    from mfl.write_weights import write_weights
+
+    kernel, bias = _weights(params)
+    group = [[{"name": "dense/kernel", "data": kernel}, {"name": "dense/bias", "data": bias}]]
+    directory = tempfile.mkdtemp(prefix="mfl-bench-")
+
+    def write():
+        write_weights(group, directory)
+        return directory
+
+    write.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+    return write
+
+
+@case("read_weights", params=[100_000, 4_000_000])
+def read_weights(params: int):
+    from mfl.read_weights import read_weights
+    from mfl.write_weights import write_weights
+
+    kernel, bias = _weights(params)
+    group = [[{"name": "dense/kernel", "data": kernel}, {"name": "dense/bias", "data": bias}]]
+    directory = tempfile.mkdtemp(prefix="mfl-bench-")
+    manifest = write_weights(group, directory)
+
+    def read():
+        return read_weights(manifest, directory)
+
+    read.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+    return read
+
+
+@case("get_keras_model_graph", units=[64, 512])
+def get_keras_model_graph(units: int):
+    from mfl.keras_h5_conversion import get_keras_model_graph
+
+    model = _model(units)
+    return lambda: get_keras_model_graph(model)
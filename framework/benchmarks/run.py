@@ -0,0 +1,160 @@
+"""Benchmarks of the hot paths of the SDK.
+
+Every case of `cases.py` is timed over its parameter grid, and the results are
+written as JSON together with the commit and the versions they were measured
+with, so that runs of different commits can be compared:
+
+    python benchmarks/run.py                       # writes results/<commit>.json
+    python benchmarks/run.py --filter quantize --quick
+    python benchmarks/run.py --compare results/<baseline>.json
+
+Each case is called `number` times per sample, with `number` picked so that a
+sample lasts at least `--min-time` seconds, and `--repeat` samples are taken.
+Times are reported per call. A case is a regression when its median is more
+than `--threshold` slower than in the baseline.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from cases import CASES  # noqa: E402
+
+
+def _instances(benchmark: Dict[str, Any]):
+    keys = list(benchmark["grid"])
+    for values in itertools.product(*(benchmark["grid"][k] for k in keys)):
+        params = dict(zip(keys, values))
+        label = ",".join(f"{k}={v}" for k, v in params.items())
+        yield f"{benchmark['name']}[{label}]" if label else benchmark["name"], params
+
+
+def measure(call: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, float]:
+    """Seconds per call of `call`, over `repeat` samples"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            call()
+        samples.append((time.perf_counter() - started) / number)
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "number": number,
+        "repeat": len(samples),
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata() -> Dict[str, Any]:
+    import numpy as np
+    import tensorflow as tf
+
+    return {
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "tensorflow": tf.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """Print the change of every case measured in both runs, return the regressions"""
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["median"]
+        ratio = result["median"] / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = "  improvement"
+        print(f"{name:<60} {before * 1e3:10.3f}ms -> {result['median'] * 1e3:10.3f}ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--quick", action="store_true", help="one short sample per case")
+    parser.add_argument("--output", help="results file, defaults to results/<commit>.json")
+    parser.add_argument("--compare", help="baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.repeat, args.min_time = 1, 0.01
+
+    metadata = _metadata()
+    results = {}
+    for benchmark in CASES:
+        for name, params in _instances(benchmark):
+            if args.filter and args.filter not in name:
+                continue
+            call = benchmark["setup"](**params)
+            results[name] = dict(measure(call, args.repeat, args.min_time), params=params)
+            print(f"{name:<60} {results[name]['median'] * 1e3:10.3f}ms")
+            if hasattr(call, "cleanup"):
+                call.cleanup()
+
+    report = {"metadata": metadata, "results": results}
+    output = args.output or os.path.join(
+        HERE, "results", f"{metadata['commit'] or 'local'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,7 @@
 import tf_keras as keras
 
+from .asynchronous import AsyncPolicy
+from .telemetry import Telemetry
+from .tracing import Tracer
 from .trainer import Trainer
+from .worker import RoundPolicy
@@ -0,0 +1,98 @@
+"""Content-addressed artifacts shared by many tasks.
+
+Payloads that are identical across tasks (e.g. the model topology) are
+published once under the hash of their content. Tasks then only carry that
+hash, and devices resolve it through an `ArtifactCache`, which fetches each
+artifact from the store once and keeps it for every later task.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+ARTIFACTS_TABLE = "model_artifacts"
+
+
+def content_hash(payload: Any) -> str:
+    """SHA-256 of bytes, or of the canonical JSON encoding of any other payload"""
+    if not isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+class InMemoryArtifactStore:
+    """
+    Local stand-in for the artifacts table, for tests and offline runs
+    """
+
+    def __init__(self):
+        self.artifacts: Dict[str, Any] = {}
+
+    def put(self, key: str, payload: Any) -> None:
+        self.artifacts[key] = payload
+
+    def get(self, key: str) -> Any:
+        if key not in self.artifacts:
+            raise KeyError(f"Artifact {key} does not exist.")
+        return self.artifacts[key]
+
+    def delete(self, key: str) -> None:
+        self.artifacts.pop(key, None)
+
+
+class SupabaseArtifactStore:
+    """
+    Stores artifacts as rows of the `model_artifacts` table, keyed by hash
+    """
+
+    def __init__(self, client, table: str = ARTIFACTS_TABLE):
+        self.client = client
+        self.table = table
+
+    def put(self, key: str, payload: Any) -> None:
+        self.client.table(self.table).upsert({"id": key, "data": payload}).execute()
+
+    def get(self, key: str) -> Any:
+        response = self.client.table(self.table).select("data").eq("id", key).execute()
+        if not response.data:
+            raise KeyError(f"Artifact {key} does not exist.")
+        return response.data[0]["data"]
+
+    def delete(self, key: str) -> None:
+        self.client.table(self.table).delete().eq("id", key).execute()
+
+
+class ArtifactCache:
+    """
+    Resolves artifacts by hash, fetching each one at most once.
+
+    This is the device side of the protocol: the first task referencing an
+    artifact pays for the fetch, every later task is served from memory. The
+    least recently used artifacts are evicted past `max_entries`.
+    """
+
+    def __init__(self, fetch: Callable[[str], Any], max_entries: Optional[int] = 32):
+        self.fetch = fetch
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.misses = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def put(self, key: str, payload: Any) -> None:
+        self.entries[key] = payload
+        self.entries.move_to_end(key)
+        if self.max_entries is not None:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def resolve(self, key: str) -> Any:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        payload = self.fetch(key)
+        self.put(key, payload)
+        return payload
@@ -0,0 +1,153 @@
+"""Asynchronous federated training (FedAsync / FedBuff).
+
+Instead of waiting for every device of a round, the server keeps a versioned
+global model and merges client updates as they arrive. Every task is sent the
+latest global weights and their version; when it completes, its update (the
+difference between the weights it trained and the weights it was sent) is
+weighted by its staleness, i.e. by how many versions the global model moved
+on in the meantime, and buffered. Every `buffer_size` updates the buffer is
+applied to the global model, which bumps its version:
+
+    w <- w + mixing * sum(s(staleness_i) * n_i * delta_i) / sum(n_i)
+
+`buffer_size=1` is FedAsync (Xie et al.), larger buffers are FedBuff (Nguyen
+et al.). The staleness functions follow FedAsync:
+  - `constant`: s(t) = 1
+  - `polynomial`: s(t) = (1 + t) ** -staleness_exponent
+  - `hinge`: s(t) = 1 if t <= hinge_offset, else
+    1 / (staleness_exponent * (t - hinge_offset) + 1)
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from .compression import SparseDelta
+
+STALENESS_FUNCTIONS = ("constant", "polynomial", "hinge")
+
+
+@dataclass
+class AsyncPolicy:
+    """
+    How client updates are merged in asynchronous training.
+
+    - buffer_size: updates merged into the global model at once (K).
+    - mixing: server learning rate applied to the buffered update.
+    - staleness: staleness function, one of `STALENESS_FUNCTIONS`.
+    - staleness_exponent, hinge_offset: parameters of the staleness function.
+    - max_staleness: updates staler than this many versions are dropped.
+      None keeps all of them.
+    - task_timeout: seconds after which a task that has not answered is
+      cancelled and its partition handed to the next idle device.
+    - idle_timeout: seconds without any response after which training stops
+      with the updates merged so far, e.g. once every device has gone. None
+      waits for every queued partition.
+    """
+
+    buffer_size: int = 1
+    mixing: float = 1.0
+    staleness: str = "polynomial"
+    staleness_exponent: float = 0.5
+    hinge_offset: int = 4
+    max_staleness: Optional[int] = None
+    task_timeout: float = 60.0
+    idle_timeout: Optional[float] = 300.0
+
+    def __post_init__(self):
+        if self.buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1, got %s" % self.buffer_size)
+        if self.staleness not in STALENESS_FUNCTIONS:
+            raise ValueError(
+                "Unsupported staleness function %r, expected one of %s"
+                % (self.staleness, ", ".join(STALENESS_FUNCTIONS))
+            )
+
+    def staleness_weight(self, staleness: int) -> float:
+        if self.staleness == "constant":
+            return 1.0
+        if self.staleness == "polynomial":
+            return float((1 + staleness) ** -self.staleness_exponent)
+        if staleness <= self.hinge_offset:
+            return 1.0
+        return 1.0 / (self.staleness_exponent * (staleness - self.hinge_offset) + 1)
+
+
+class AsyncAggregator:
+    """
+    Versioned global model that buffers and merges stale client updates.
+
+    The weights of every version a pending task was sent are kept, so that the
+    update of a client can be computed against the weights it started from.
+    """
+
+    def __init__(self, global_weights: List[np.ndarray], policy: AsyncPolicy):
+        self.policy = policy
+        self.version = 0
+        self.weights = [np.asarray(w, dtype=np.float32) for w in global_weights]
+        self.snapshots: Dict[int, List[np.ndarray]] = {0: self.weights}
+        self.buffer: Optional[List[np.ndarray]] = None
+        self.buffer_samples = 0
+        self.buffered = 0
+        self.num_merges = 0
+        self.num_dropped = 0
+
+    def add(
+        self,
+        version: int,
+        num_samples: int = 1,
+        weights: Optional[List[np.ndarray]] = None,
+        deltas: Optional[List[SparseDelta]] = None,
+    ) -> bool:
+        """
+        Buffer the update of a client that started from `version`, given as
+        its trained weights or as sparse deltas. Returns whether the buffer was
+        merged into the global model.
+        """
+        staleness = self.version - version
+        if version not in self.snapshots or (
+            self.policy.max_staleness is not None
+            and staleness > self.policy.max_staleness
+        ):
+            self.num_dropped += 1
+            return False
+
+        if self.buffer is None:
+            self.buffer = [np.zeros(w.shape, dtype=np.float64) for w in self.weights]
+        scale = self.policy.staleness_weight(staleness) * num_samples
+        if weights is not None:
+            for buffer, new, old in zip(self.buffer, weights, self.snapshots[version]):
+                buffer += scale * (np.asarray(new, dtype=np.float64) - old)
+        if deltas is not None:
+            for buffer, delta in zip(self.buffer, deltas):
+                np.add.at(buffer.reshape(-1), delta.indices, scale * delta.values)
+        self.buffer_samples += num_samples
+        self.buffered += 1
+
+        if self.buffered >= self.policy.buffer_size:
+            self.merge()
+            return True
+        return False
+
+    def merge(self) -> None:
+        """Apply the buffered updates to the global model as a new version"""
+        if not self.buffered:
+            return
+        factor = self.policy.mixing / self.buffer_samples
+        self.weights = [
+            (w + factor * update).astype(w.dtype)
+            for w, update in zip(self.weights, self.buffer)
+        ]
+        self.version += 1
+        self.snapshots[self.version] = self.weights
+        self.buffer = None
+        self.buffer_samples = 0
+        self.buffered = 0
+        self.num_merges += 1
+
+    def release(self, live_versions: Iterable[int]) -> None:
+        """Forget the snapshots no pending task started from"""
+        keep = set(live_versions) | {self.version}
+        for version in [v for v in self.snapshots if v not in keep]:
+            del self.snapshots[version]
@@ -0,0 +1,285 @@
+"""Backends the worker exchanges tasks through.
+
+A backend stores task requests, lists the available devices (as rows with
+their `id` and `last_updated`) and delivers the realtime changes of the
+`devices` and `task_responses` tables. Every call is a coroutine, so that the
+event loop keeps handling realtime callbacks while requests are in flight.
+
+Two backends are available:
+  - `SupabaseBackend`: the Supabase project configured by `SUPABASE_URL` and
+    `SUPABASE_ANON_KEY`. Its client is created on first use, and its blocking
+    HTTP calls run on a bounded thread pool. Its realtime session is kept
+    alive by heartbeats and reopened whenever the connection drops.
+  - `InMemoryBackend`: a local stand-in for tests and offline runs, whose
+    devices are driven by calling `set_device_status` and `respond`.
+"""
+
+import asyncio
+import functools
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from realtime._async.client import AsyncRealtimeClient
+from supabase import Client, create_client
+
+from .artifacts import InMemoryArtifactStore, SupabaseArtifactStore
+
+load_dotenv()
+MAX_CONCURRENT_REQUESTS = 8
+HEARTBEAT_INTERVAL = 15  # seconds
+INITIAL_BACKOFF = 1.0  # seconds before the first reconnection attempt
+MAX_BACKOFF = 30.0  # seconds
+
+RealtimeCallback = Callable[[Dict], None]
+ReconnectCallback = Callable[[], Awaitable[None]]
+
+
+def _realtime_payload(record: Dict[str, Any]) -> Dict:
+    """Wrap a row the way realtime change payloads carry it"""
+    return {"data": {"record": record}}
+
+
+class SupabaseBackend:
+    """
+    Supabase tables and realtime channels.
+
+    At most `max_workers` requests are in flight at once, they share the
+    connection pool of one client. The realtime session sends a heartbeat
+    every `heartbeat_interval` seconds; when it drops, it is reopened with
+    exponential backoff and `on_reconnect` is awaited so that the caller can
+    catch up on the changes it missed.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        key: Optional[str] = None,
+        max_workers: int = MAX_CONCURRENT_REQUESTS,
+        heartbeat_interval: int = HEARTBEAT_INTERVAL,
+    ):
+        self.url = url if url is not None else os.getenv("SUPABASE_URL")
+        self.key = key if key is not None else os.getenv("SUPABASE_ANON_KEY")
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="mfl-backend"
+        )
+        self._client: Optional[Client] = None
+        self.heartbeat_interval = heartbeat_interval
+        self.realtime: Optional[AsyncRealtimeClient] = None
+        self.listener: Optional[asyncio.Task] = None
+        self.on_device_update: Optional[RealtimeCallback] = None
+        self.on_task_response: Optional[RealtimeCallback] = None
+        self.on_reconnect: Optional[ReconnectCallback] = None
+
+    @property
+    def client(self) -> Client:
+        """The Supabase client, created on first use"""
+        if self._client is None:
+            self._client = create_client(self.url, self.key)
+        return self._client
+
+    async def offload(self, fn: Callable, *args) -> Any:
+        """Run a blocking call on the backend's thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    def artifact_store(self) -> SupabaseArtifactStore:
+        # The store queries tables through the backend, which creates the client
+        return SupabaseArtifactStore(self)
+
+    async def insert_task_requests(self, rows: List[Dict]) -> List[Dict]:
+        query = self.client.table("task_requests").insert(rows)
+        response = await self.offload(query.execute)
+        return response.data
+
+    async def delete_task_requests(self, task_ids: List[int]) -> None:
+        query = self.client.table("task_requests").delete().in_("id", task_ids)
+        await self.offload(query.execute)
+
+    async def available_devices(self, active_since: datetime) -> List[Dict]:
+        query = (
+            self.client.table("devices")
+            .select("id, last_updated")
+            .eq("status", "available")
+            .gte("last_updated", active_since.isoformat())
+        )
+        response = await self.offload(query.execute)
+        return response.data
+
+    async def fetch_task_responses(self, task_ids: List[int]) -> List[Dict]:
+        query = self.client.table("task_responses").select("id, data").in_("id", task_ids)
+        response = await self.offload(query.execute)
+        return response.data
+
+    async def connect(
+        self,
+        on_device_update: RealtimeCallback,
+        on_task_response: RealtimeCallback,
+        on_reconnect: Optional[ReconnectCallback] = None,
+    ) -> None:
+        """
+        We subscribe to realtime updates of the devices and task_responses
+        tables and pass them to the given callbacks until `close` is called
+        """
+        self.on_device_update = on_device_update
+        self.on_task_response = on_task_response
+        self.on_reconnect = on_reconnect
+        self.realtime = await self._subscribe()
+        self.listener = asyncio.create_task(self._listen())
+
+    async def _subscribe(self) -> AsyncRealtimeClient:
+        """
+        Open a realtime connection and join the channels of both tables
+        """
+        # The client's own reconnection is not used, `_listen` reopens sessions
+        client = AsyncRealtimeClient(
+            f"{self.url}/realtime/v1",
+            self.key,
+            auto_reconnect=False,
+            hb_interval=self.heartbeat_interval,
+        )
+        await client.connect()
+
+        device_channel = client.channel("devices")
+        task_completion_channel = client.channel("task_responses")
+
+        await device_channel.on_postgres_changes(
+            "UPDATE",
+            schema="public",
+            table="devices",
+            callback=self.on_device_update,
+        ).subscribe()
+
+        await task_completion_channel.on_postgres_changes(
+            "INSERT",
+            schema="public",
+            table="task_responses",
+            callback=self.on_task_response,
+        ).subscribe()
+
+        return client
+
+    async def _listen(self) -> None:
+        """
+        Listen until cancelled, reopening the session whenever it drops
+        """
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                if self.realtime is None:
+                    self.realtime = await self._subscribe()
+                    backoff = INITIAL_BACKOFF
+                    if self.on_reconnect is not None:
+                        await self.on_reconnect()
+                # Returns once the connection is closed
+                await self.realtime.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Realtime connection lost: {e}")
+            self.realtime = None
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def close(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        if self.realtime is not None:
+            try:
+                await self.realtime.close()
+            except Exception as e:
+                print(f"Error closing realtime connection: {e}")
+            self.realtime = None
+
+
+class InMemoryBackend:
+    """
+    Local stand-in for the Supabase tables and realtime channels
+    """
+
+    def __init__(self):
+        self.devices: Dict[int, Dict[str, Any]] = {}
+        self.task_requests: Dict[int, Dict[str, Any]] = {}
+        self.task_responses: Dict[int, Dict[str, Any]] = {}
+        self.store = InMemoryArtifactStore()
+        self.task_ids = itertools.count(1)
+        self.on_device_update: Optional[RealtimeCallback] = None
+        self.on_task_response: Optional[RealtimeCallback] = None
+
+    async def offload(self, fn: Callable, *args) -> Any:
+        return fn(*args)
+
+    def artifact_store(self) -> InMemoryArtifactStore:
+        return self.store
+
+    async def insert_task_requests(self, rows: List[Dict]) -> List[Dict]:
+        records = []
+        for row in rows:
+            record = dict(
+                row,
+                id=next(self.task_ids),
+                created_at=datetime.now(timezone.utc).isoformat(),
+            )
+            self.task_requests[record["id"]] = record
+            records.append(record)
+        return records
+
+    async def delete_task_requests(self, task_ids: List[int]) -> None:
+        for task_id in task_ids:
+            self.task_requests.pop(task_id, None)
+
+    async def available_devices(self, active_since: datetime) -> List[Dict]:
+        return [
+            {"id": device_id, "last_updated": device["last_updated"]}
+            for device_id, device in self.devices.items()
+            if device["status"] == "available" and device["last_updated"] >= active_since
+        ]
+
+    async def fetch_task_responses(self, task_ids: List[int]) -> List[Dict]:
+        return [
+            self.task_responses[task_id]
+            for task_id in task_ids
+            if task_id in self.task_responses
+        ]
+
+    async def connect(
+        self,
+        on_device_update: RealtimeCallback,
+        on_task_response: RealtimeCallback,
+        on_reconnect: Optional[ReconnectCallback] = None,
+    ) -> None:
+        self.on_device_update = on_device_update
+        self.on_task_response = on_task_response
+
+    async def close(self) -> None:
+        self.on_device_update = None
+        self.on_task_response = None
+
+    def set_device_status(self, device_id: int, status: str) -> None:
+        """Update a device row, as the app does when its status changes"""
+        record = {
+            "id": device_id,
+            "status": status,
+            "last_updated": datetime.now(timezone.utc),
+        }
+        self.devices[device_id] = record
+        if self.on_device_update is not None:
+            self.on_device_update(_realtime_payload(record))
+
+    def respond(self, task_id: int, data: Dict) -> None:
+        """Insert the response of a task, as the app does once it is done"""
+        record = {
+            "id": task_id,
+            "data": data,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.task_responses[task_id] = record
+        if self.on_task_response is not None:
+            self.on_task_response(_realtime_payload(record))
@@ -0,0 +1,336 @@
+"""Wire codecs for the payloads exchanged with devices.
+
+A codec turns the fields of a `RequestConfig` into the JSON document stored in
+the `data` column of `task_requests`, and turns the `data` column of a
+`task_responses` row back into the fields of a `ResponseConfig`.
+
+Two codecs are available:
+  - `json`: every tensor is sent as nested lists of numbers. This is the format
+    understood by every build of the app.
+  - `binary`: every tensor field is sent as an envelope holding the raw
+    little-endian bytes of the tensors (base64 encoded, since the column is
+    JSONB) and a manifest describing them. The manifest uses the same schema as
+    the weights manifest written by `write_weights` (name, shape, dtype).
+    Weights can optionally be quantized, in which case the manifest entry of
+    each quantized tensor also carries its `quantization` metadata.
+
+Both codecs also carry sparse top-k weight updates (see `compression.py`) in the
+`deltas` field of a response.
+"""
+
+import base64
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .compression import SparseDelta
+from .quantization import (
+    QUANTIZATION_OPTION_TO_DTYPES,
+    map_layers_to_quantization_dtype,
+)
+from .read_weights import decode_weights
+from .write_weights import (
+    _AUTO_DTYPE_CONVERSION,
+    _get_weights_manifest_for_group,
+    _quantize_entry,
+)
+
+JSON_CODEC = "json"
+BINARY_CODEC = "binary"
+
+# Key marking a request payload as binary encoded.
+ENCODING_KEY = "encoding"
+# Keys of a binary tensor envelope.
+ENVELOPE_MANIFEST_KEY = "manifest"
+ENVELOPE_DATA_KEY = "data"
+# Dense shape of each tensor of a sparse delta envelope.
+ENVELOPE_SHAPES_KEY = "shapes"
+
+
+def is_envelope(value) -> bool:
+    """Check whether a payload field holds a binary tensor envelope."""
+    return isinstance(value, dict) and ENVELOPE_MANIFEST_KEY in value
+
+
+def encode_tensors(
+    names: Sequence[str],
+    tensors: Sequence[np.ndarray],
+    quantization_dtype: Optional[Dict] = None,
+) -> Dict:
+    """Pack tensors into a binary envelope.
+
+    Args:
+      names: The name of each tensor, used as the manifest entry name.
+      tensors: The numpy arrays to pack, in order.
+      quantization_dtype: (Optional) A mapping from tensor name to the numpy
+        dtype it is quantized to, as returned by
+        `map_layers_to_quantization_dtype`. Only float32 tensors are quantized.
+
+    Returns:
+      A dict with the manifest of the tensors and their concatenated
+      little-endian bytes, base64 encoded.
+    """
+    quantization_dtype = quantization_dtype or {}
+    entries = []
+    for name, tensor in zip(names, tensors):
+        data = np.asarray(tensor)
+        dtype = np.dtype(_AUTO_DTYPE_CONVERSION.get(data.dtype, data.dtype))
+        entry = {"name": name, "data": np.asarray(data, dtype=dtype)}
+        if name in quantization_dtype:
+            entry = _quantize_entry(entry, quantization_dtype[name])
+        entry["data"] = np.ascontiguousarray(
+            entry["data"], dtype=entry["data"].dtype.newbyteorder("<")
+        )
+        entries.append(entry)
+
+    buffer = b"".join(entry["data"].tobytes() for entry in entries)
+    return {
+        ENVELOPE_MANIFEST_KEY: _get_weights_manifest_for_group(entries),
+        ENVELOPE_DATA_KEY: base64.b64encode(buffer).decode("ascii"),
+    }
+
+
+def decode_tensors(envelope: Dict) -> List[np.ndarray]:
+    """Unpack the tensors of a binary envelope, in manifest order."""
+    buffer = base64.b64decode(envelope[ENVELOPE_DATA_KEY])
+    group = decode_weights(
+        [{"weights": envelope[ENVELOPE_MANIFEST_KEY]}], buffer, flatten=True
+    )
+    return [entry["data"] for entry in group]
+
+
+def encode_sparse_deltas(names: Sequence[str], deltas: Sequence[SparseDelta]) -> Dict:
+    """Pack sparse deltas into a binary envelope.
+
+    Each delta is stored as two manifest entries, `<name>/indices` (int32) and
+    `<name>/values` (float32), and the dense shapes are listed under `shapes`.
+    """
+    entry_names, tensors = [], []
+    for name, delta in zip(names, deltas):
+        entry_names += [f"{name}/indices", f"{name}/values"]
+        tensors += [
+            np.asarray(delta.indices, np.int32),
+            np.asarray(delta.values, np.float32),
+        ]
+    envelope = encode_tensors(entry_names, tensors)
+    envelope[ENVELOPE_SHAPES_KEY] = [list(delta.shape) for delta in deltas]
+    return envelope
+
+
+def decode_sparse_deltas(envelope: Dict) -> List[SparseDelta]:
+    """Unpack the sparse deltas of a binary envelope"""
+    tensors = decode_tensors(envelope)
+    return [
+        SparseDelta(indices=indices, values=values, shape=tuple(shape))
+        for indices, values, shape in zip(
+            tensors[::2], tensors[1::2], envelope[ENVELOPE_SHAPES_KEY]
+        )
+    ]
+
+
+def _sparse_deltas_to_json(deltas: Sequence[SparseDelta]) -> List[Dict]:
+    return [
+        {
+            "shape": list(delta.shape),
+            "indices": np.asarray(delta.indices).tolist(),
+            "values": np.asarray(delta.values).tolist(),
+        }
+        for delta in deltas
+    ]
+
+
+def _sparse_deltas_from_json(items: Sequence[Dict]) -> List[SparseDelta]:
+    return [
+        SparseDelta(
+            indices=np.asarray(item["indices"], dtype=np.int32),
+            values=np.asarray(item["values"], dtype=np.float32),
+            shape=tuple(item["shape"]),
+        )
+        for item in items
+    ]
+
+
+def _tensor_names(prefix: str, count: int, names: Optional[Sequence[str]] = None):
+    if names is not None and len(names) == count:
+        return list(names)
+    return [f"{prefix}/{i}" for i in range(count)]
+
+
+class JsonCodec:
+    """Sends every tensor as nested lists of numbers"""
+
+    name = JSON_CODEC
+
+    def encode_weights(self, weights: Sequence[np.ndarray]) -> List:
+        """Convert model weights into their payload form"""
+        return [np.asarray(w).tolist() for w in weights]
+
+    def encode_request(self, request_data: Dict) -> Dict:
+        """Convert request fields into a JSON serializable payload"""
+        payload = {}
+        for key, value in request_data.items():
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, list):
+                value = [v.tolist() if isinstance(v, np.ndarray) else v for v in value]
+            payload[key] = value
+        return payload
+
+    def encode_response(self, response_data: Dict) -> Dict:
+        """Convert response fields into a payload, as a device would"""
+        payload = self.encode_request(
+            {k: v for k, v in response_data.items() if k != "deltas"}
+        )
+        if response_data.get("deltas") is not None:
+            payload["deltas"] = _sparse_deltas_to_json(response_data["deltas"])
+        return payload
+
+    def decode_response(self, response_data: Dict) -> Dict:
+        """Convert a response payload into response fields"""
+        fields = dict(response_data)
+        if fields.get("weights") is not None:
+            fields["weights"] = [
+                np.asarray(w, dtype=np.float32) for w in fields["weights"]
+            ]
+        if fields.get("deltas") is not None:
+            fields["deltas"] = _sparse_deltas_from_json(fields["deltas"])
+        return fields
+
+
+class BinaryCodec:
+    """Sends every tensor field as a binary envelope.
+
+    When a `quantization_dtype_map` is given, the matching weights are quantized
+    before being sent. Devices quantize the weights they upload with the dtype
+    found in the manifest entry of the same weight, and the quantization
+    metadata of each uploaded tensor is used to dequantize it on arrival.
+    """
+
+    name = BINARY_CODEC
+
+    def __init__(
+        self,
+        weight_names: Optional[Sequence[str]] = None,
+        quantization_dtype_map: Optional[Dict] = None,
+    ):
+        self.weight_names = weight_names
+        self.quantization_dtype = map_layers_to_quantization_dtype(
+            list(weight_names or []), quantization_dtype_map
+        )
+
+    def encode_weights(self, weights: Sequence[np.ndarray]) -> Dict:
+        """Convert model weights into their payload form"""
+        names = _tensor_names("weights", len(weights), self.weight_names)
+        return encode_tensors(
+            names, weights, quantization_dtype=self.quantization_dtype
+        )
+
+    def encode_request(self, request_data: Dict) -> Dict:
+        """Convert request fields into a payload with binary tensor envelopes"""
+        payload = dict(request_data)
+        payload[ENCODING_KEY] = BINARY_CODEC
+
+        weights = payload.get("weights")
+        if weights is not None and not is_envelope(weights):
+            payload["weights"] = self.encode_weights(weights)
+
+        for key in ("inputs", "outputs"):
+            value = payload.get(key)
+            if value is not None and not is_envelope(value):
+                payload[key] = encode_tensors([key], [value])
+
+        return payload
+
+    def encode_response(
+        self, response_data: Dict, manifest: Optional[List[Dict]] = None
+    ) -> Dict:
+        """Convert response fields into a payload, as a device would.
+
+        Args:
+          response_data: The fields of a `ResponseConfig`.
+          manifest: (Optional) The weights manifest of the request being
+            answered. Weights are quantized with the dtype of their entry in it.
+        """
+        payload = dict(response_data)
+        payload[ENCODING_KEY] = BINARY_CODEC
+        names = [entry["name"] for entry in manifest or []]
+
+        weights = payload.get("weights")
+        if weights is not None and not is_envelope(weights):
+            quantization_dtype = {
+                entry["name"]: QUANTIZATION_OPTION_TO_DTYPES[
+                    entry["quantization"]["dtype"]
+                ]
+                for entry in manifest or []
+                if "quantization" in entry
+            }
+            payload["weights"] = encode_tensors(
+                _tensor_names("weights", len(weights), names),
+                weights,
+                quantization_dtype=quantization_dtype,
+            )
+
+        deltas = payload.get("deltas")
+        if deltas is not None and not is_envelope(deltas):
+            payload["deltas"] = encode_sparse_deltas(
+                _tensor_names("weights", len(deltas), names), deltas
+            )
+
+        outputs = payload.get("outputs")
+        if outputs is not None and not is_envelope(outputs):
+            payload["outputs"] = encode_tensors(
+                _tensor_names("outputs", len(outputs)), outputs
+            )
+
+        return payload
+
+    def decode_response(self, response_data: Dict) -> Dict:
+        """Convert a response payload into response fields.
+
+        Responses from app builds that only speak JSON are decoded as well.
+        """
+        fields = dict(response_data)
+        fields.pop(ENCODING_KEY, None)
+
+        weights = fields.get("weights")
+        if is_envelope(weights):
+            fields["weights"] = [w.astype(np.float32) for w in decode_tensors(weights)]
+        elif weights is not None:
+            fields["weights"] = [np.asarray(w, dtype=np.float32) for w in weights]
+
+        deltas = fields.get("deltas")
+        if is_envelope(deltas):
+            fields["deltas"] = decode_sparse_deltas(deltas)
+        elif deltas is not None:
+            fields["deltas"] = _sparse_deltas_from_json(deltas)
+
+        outputs = fields.get("outputs")
+        if is_envelope(outputs):
+            fields["outputs"] = decode_tensors(outputs)
+
+        return fields
+
+
+CODECS = {
+    JSON_CODEC: JsonCodec,
+    BINARY_CODEC: BinaryCodec,
+}
+
+
+def get_codec(
+    name: str,
+    weight_names: Optional[Sequence[str]] = None,
+    quantization_dtype_map: Optional[Dict] = None,
+):
+    """Create the codec registered under `name`"""
+    if name == BINARY_CODEC:
+        return BinaryCodec(
+            weight_names=weight_names, quantization_dtype_map=quantization_dtype_map
+        )
+    if name == JSON_CODEC:
+        if quantization_dtype_map:
+            raise ValueError("Weight quantization requires the binary codec")
+        return JsonCodec()
+    raise ValueError(
+        "Unsupported codec %r, expected one of %s" % (name, ", ".join(CODECS))
+    )
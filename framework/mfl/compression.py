@@ -0,0 +1,91 @@
+"""Sparse top-k compression of weight updates uploaded by devices.
+
+Instead of uploading every weight, a device can upload only the k largest
+entries (in magnitude) of its update, i.e. of the difference between the
+weights it trained and the weights it was sent. The entries that were dropped
+are not lost: they are kept on the device as an error-feedback residual and
+added to its next update, so every coordinate is eventually applied.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass
+class SparseDelta:
+    """The top-k entries of a weight update, as flat indices and values"""
+
+    indices: np.ndarray
+    values: np.ndarray
+    shape: Tuple[int, ...]
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64))
+
+
+def top_k_count(size: int, fraction: float) -> int:
+    """Number of entries kept out of `size` for a top-k `fraction`"""
+    if not 0 < fraction <= 1:
+        raise ValueError("Top-k fraction must be in (0, 1], got %s" % fraction)
+    return min(size, max(1, int(math.ceil(size * fraction))))
+
+
+def top_k_sparsify(delta: np.ndarray, fraction: float) -> SparseDelta:
+    """Keep the `fraction` of entries of `delta` with the largest magnitude."""
+    flat = np.ravel(delta)
+    k = top_k_count(flat.size, fraction)
+    if k == flat.size:
+        indices = np.arange(flat.size, dtype=np.int32)
+    else:
+        indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k :]
+        indices = np.sort(indices).astype(np.int32)
+    return SparseDelta(
+        indices=indices,
+        values=flat[indices].astype(np.float32),
+        shape=tuple(np.shape(delta)),
+    )
+
+
+def densify(delta: SparseDelta) -> np.ndarray:
+    """Scatter a sparse delta back into a dense float32 array"""
+    dense = np.zeros(delta.size, dtype=np.float32)
+    dense[delta.indices] = delta.values
+    return dense.reshape(delta.shape)
+
+
+class TopKCompressor:
+    """
+    Device side top-k compression with error feedback.
+
+    One compressor is kept per device, since the residual carries the part of
+    the device's past updates that has not been uploaded yet.
+    """
+
+    def __init__(self, fraction: float):
+        self.fraction = fraction
+        self.residuals: Optional[List[np.ndarray]] = None
+
+    def compress(
+        self,
+        new_weights: Sequence[np.ndarray],
+        broadcast_weights: Sequence[np.ndarray],
+    ) -> List[SparseDelta]:
+        """Sparsify (new - broadcast) plus the residual, and keep the remainder"""
+        if self.residuals is None:
+            self.residuals = [np.zeros(np.shape(w), np.float32) for w in new_weights]
+
+        deltas = []
+        for i, (new, old) in enumerate(zip(new_weights, broadcast_weights)):
+            update = (
+                np.asarray(new, np.float32) - np.asarray(old, np.float32)
+            ) + self.residuals[i]
+            sparse = top_k_sparsify(update, self.fraction)
+            residual = update.ravel()
+            residual[sparse.indices] = 0.0
+            self.residuals[i] = residual.reshape(update.shape)
+            deltas.append(sparse)
+        return deltas
@@ -1,3 +1,4 @@
+import hashlib
 import math
 from typing import List, Optional, Tuple
 
@@ -64,6 +65,7 @@ def split_datasets(
     devices: List[int],
     outputs: Optional[np.ndarray] = None,
     include_outputs: bool = False,
+    sizes: Optional[List[int]] = None,
 ) -> List[Tuple[int, np.ndarray, Optional[np.ndarray]]]:
     """
     Shuffle and split inputs and outputs into roughly equal parts for each device without truncating data points.
@@ -74,6 +76,8 @@ def split_datasets(
         batch_size (int): Size of each batch. (Unused in splitting)
         outputs (Optional[np.ndarray], optional): Output data. Defaults to None.
         include_outputs (bool, optional): Whether to include outputs in the split. Defaults to False.
+        sizes (Optional[List[int]], optional): Number of samples of each device, e.g. from
+            `partition_sizes`. Must sum to the number of samples. Defaults to equal parts.
 
     Returns:
         List[Tuple[int, np.ndarray, Optional[np.ndarray]]]: 
@@ -89,16 +93,19 @@ def split_datasets(
     validate_dataset(inputs, outputs)
 
     total_samples = len(inputs)
-    samples_per_device = total_samples // num_devices
-    remainder = total_samples % num_devices
+    if sizes is None:
+        samples_per_device = total_samples // num_devices
+        remainder = total_samples % num_devices
+        sizes = [samples_per_device + (1 if i < remainder else 0) for i in range(num_devices)]
+    elif len(sizes) != num_devices or sum(sizes) != total_samples:
+        raise ValueError("Partition sizes must give one size per device and sum to the number of samples")
 
     datasets = []
     start_idx = 0
 
     for i, device in enumerate(devices):
 
-        current_samples = samples_per_device + (1 if i < remainder else 0)
-        end_idx = start_idx + current_samples
+        end_idx = start_idx + sizes[i]
         device_inputs = np.asarray(inputs[start_idx:end_idx])
         device_outputs = np.asarray(outputs[start_idx:end_idx]) if include_outputs else None
 
@@ -114,3 +121,85 @@ def split_datasets(
     assert start_idx == total_samples, "Not all samples were assigned to devices."
 
     return datasets
+
+
+def partition_sizes(
+    total_samples: int,
+    capacities: List[float],
+    min_samples: int = 1,
+    max_samples: Optional[int] = None,
+) -> List[int]:
+    """
+    Size each device's share of the data in proportion to its capacity, so that all devices are
+    expected to finish at the same time.
+
+    Shares are `scale * capacity` clipped to `[min_samples, max_samples]`, with the scale chosen so
+    that they sum to `total_samples`, then rounded to whole samples by largest remainder.
+
+    Args:
+        total_samples (int): Number of samples to split.
+        capacities (List[float]): Throughput of each device, e.g. in samples per second.
+        min_samples (int): Floor of every share. Defaults to 1.
+        max_samples (Optional[int]): Cap of every share. Defaults to None (no cap).
+
+    Returns:
+        List[int]: Number of samples of each device, summing to `total_samples`.
+    """
+    num_devices = len(capacities)
+    if num_devices == 0:
+        raise ValueError("No devices available for training.")
+    if min_samples * num_devices > total_samples:
+        raise ValueError(f"Cannot give {num_devices} devices at least {min_samples} of {total_samples} samples")
+    if max_samples is not None and max_samples * num_devices < total_samples:
+        raise ValueError(f"Cannot give {num_devices} devices at most {max_samples} of {total_samples} samples")
+
+    capacities = np.maximum(np.asarray(capacities, dtype=np.float64), 0.0)
+    if not capacities.any():
+        capacities = np.ones(num_devices)
+    upper = np.inf if max_samples is None else max_samples
+
+    def shares(scale: float) -> np.ndarray:
+        return np.clip(scale * capacities, min_samples, upper)
+
+    # The total of the shares grows with the scale, bisect for the one that hits total_samples
+    low, high = 0.0, total_samples / capacities[capacities > 0].min()
+    for _ in range(100):
+        middle = (low + high) / 2
+        if shares(middle).sum() < total_samples:
+            low = middle
+        else:
+            high = middle
+    exact = shares(high)
+
+    sizes = np.floor(exact).astype(np.int64)
+    order = np.argsort(sizes - exact, kind="stable")
+    missing = total_samples - int(sizes.sum())
+    for i in order:
+        if missing <= 0:
+            break
+        if sizes[i] < upper:
+            sizes[i] += 1
+            missing -= 1
+    return sizes.tolist()
+
+
+def partition_hash(inputs: np.ndarray, outputs: Optional[np.ndarray] = None) -> str:
+    """
+    Content hash of a device's data partition, covering shapes, dtypes and values.
+
+    Args:
+        inputs (np.ndarray): Input subset for the device.
+        outputs (Optional[np.ndarray]): Output subset for the device, if any.
+
+    Returns:
+        str: Hex SHA-256 digest identifying the partition.
+    """
+    digest = hashlib.sha256()
+    for array in (inputs, outputs):
+        if array is None:
+            digest.update(b"none")
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+    return digest.hexdigest()
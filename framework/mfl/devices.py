@@ -0,0 +1,122 @@
+"""Registry of the devices currently available to take tasks.
+
+The registry is seeded once from the `devices` table and then kept current by
+the realtime updates of that table, so rounds do not query the table to learn
+which devices are online. The app refreshes `last_updated` with a heartbeat
+while it is online, so devices that stop updating for longer than the TTL are
+considered gone. Devices that are online but busy, e.g. with the job of
+another consumer, are kept with their status and only count as available
+once they report `available` again.
+"""
+
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from dateutil.parser import parse
+
+DEVICE_TTL = 60  # seconds, the app heartbeats every 45
+
+
+def _age(last_updated) -> float:
+    """Seconds elapsed since a `last_updated` timestamp, 0 when unknown"""
+    if last_updated is None:
+        return 0.0
+    if isinstance(last_updated, str):
+        last_updated = parse(last_updated)
+    if last_updated.tzinfo is None:
+        last_updated = last_updated.replace(tzinfo=timezone.utc)
+    return max(0.0, (datetime.now(timezone.utc) - last_updated).total_seconds())
+
+
+class DeviceRegistry:
+    """
+    Online devices by id with their last status, with O(1) lookups and
+    updates. Membership, length and iteration only count available devices.
+
+    Entries are ordered by when they were last seen, so expiring the ones
+    older than `ttl` seconds only touches the expired entries. `on_drop` is
+    called with the id of every device that goes offline, whether it reports
+    `unavailable`, expires or is missing when the registry is seeded again.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEVICE_TTL,
+        on_drop: Optional[Callable[[int], None]] = None,
+    ):
+        self.ttl = ttl
+        self.on_drop = on_drop
+        self.last_seen: "OrderedDict[int, float]" = OrderedDict()
+        self.status: Dict[int, str] = {}
+        self.seeded = False
+
+    def __contains__(self, device_id: int) -> bool:
+        self.expire()
+        return self.status.get(device_id) == "available"
+
+    def __len__(self) -> int:
+        return len(self.available())
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.available())
+
+    def seed(self, devices: Iterable[Dict]) -> None:
+        """Replace the registry with rows of the devices table (id, last_updated)"""
+        now = time.monotonic()
+        seen = sorted(
+            (now - _age(device.get("last_updated")), device["id"]) for device in devices
+        )
+        online = {device_id for _, device_id in seen}
+        dropped = [device_id for device_id in self.last_seen if device_id not in online]
+        self.last_seen = OrderedDict((device_id, at) for at, device_id in seen)
+        self.status = {device_id: "available" for device_id in self.last_seen}
+        self.seeded = True
+        self._dropped(dropped)
+
+    def update(self, device_id: int, status: str) -> bool:
+        """
+        Apply a status update of a device. Returns whether the device has just
+        become available.
+        """
+        if status == "unavailable":
+            if self.status.pop(device_id, None) is not None:
+                self.last_seen.pop(device_id, None)
+                self._dropped([device_id])
+            return False
+        # Other statuses (e.g. busy) keep the device online but not available
+        joined = status == "available" and self.status.get(device_id) != "available"
+        self.last_seen[device_id] = time.monotonic()
+        self.last_seen.move_to_end(device_id)
+        self.status[device_id] = status
+        return joined
+
+    def expire(self, now: Optional[float] = None) -> List[int]:
+        """Drop the devices not seen for `ttl` seconds and return them"""
+        deadline = (time.monotonic() if now is None else now) - self.ttl
+        expired = []
+        while self.last_seen:
+            device_id, seen_at = next(iter(self.last_seen.items()))
+            if seen_at >= deadline:
+                break
+            self.last_seen.popitem(last=False)
+            self.status.pop(device_id, None)
+            expired.append(device_id)
+        self._dropped(expired)
+        return expired
+
+    def available(self) -> List[int]:
+        """Ids of the available devices, least recently seen first"""
+        self.expire()
+        return [
+            device_id
+            for device_id in self.last_seen
+            if self.status[device_id] == "available"
+        ]
+
+    def _dropped(self, device_ids: List[int]) -> None:
+        """Report devices that went offline to `on_drop`"""
+        if self.on_drop is not None:
+            for device_id in device_ids:
+                self.on_drop(device_id)
@@ -1,7 +1,9 @@
-from typing import List, Tuple
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 
+from .compression import SparseDelta
+
 
 def average_model_weights(all_weights: List[List[np.ndarray]]) -> List[np.ndarray]:
     """Compute average of model weights"""
@@ -12,6 +14,140 @@ def average_model_weights(all_weights: List[List[np.ndarray]]) -> List[np.ndarra
     return averaged_weights
 
 
+class FedAvgAccumulator:
+    """
+    Streaming, sample-weighted average of client updates.
+
+    Client updates are folded in one at a time into preallocated float64
+    buffers, so aggregation memory stays at O(model) no matter how many clients
+    report. Dense updates (full weights) are accumulated directly; sparse
+    updates are accumulated as deltas to `global_weights`, which is then
+    required.
+    """
+
+    def __init__(self, global_weights: Optional[List[np.ndarray]] = None):
+        self.global_weights = global_weights
+        self.weight_sums: Optional[List[np.ndarray]] = None
+        self.delta_sums: Optional[List[np.ndarray]] = None
+        self.dense_samples = 0.0
+        self.sparse_samples = 0.0
+        self.num_updates = 0
+
+    @property
+    def total_samples(self) -> float:
+        return self.dense_samples + self.sparse_samples
+
+    def _buffers(self, like: Sequence[np.ndarray]) -> List[np.ndarray]:
+        return [np.zeros(np.shape(w), dtype=np.float64) for w in like]
+
+    def add(self, weights: Sequence[np.ndarray], num_samples: float = 1) -> None:
+        """Fold in the full weights of one client"""
+        if self.weight_sums is None:
+            self.weight_sums = self._buffers(weights)
+        for weight_sum, layer in zip(self.weight_sums, weights):
+            weight_sum += num_samples * np.asarray(layer, dtype=np.float64)
+        self.dense_samples += num_samples
+        self.num_updates += 1
+
+    def add_sparse(self, deltas: Sequence[SparseDelta], num_samples: float = 1) -> None:
+        """Fold in the sparse delta of one client without densifying it"""
+        if self.global_weights is None:
+            raise ValueError("Sparse updates require the global weights")
+        if self.delta_sums is None:
+            self.delta_sums = self._buffers(self.global_weights)
+        for delta_sum, delta in zip(self.delta_sums, deltas):
+            # Top-k indices are unique within a tensor, so a fancy-indexed
+            # add is equivalent to np.add.at and much faster.
+            delta_sum.reshape(-1)[delta.indices] += num_samples * delta.values
+        self.sparse_samples += num_samples
+        self.num_updates += 1
+
+    def result(self) -> List[np.ndarray]:
+        """Sample-weighted average of every update folded in so far"""
+        if self.num_updates == 0:
+            raise ValueError("No client updates to average")
+
+        reference = self.global_weights
+        if reference is None:
+            reference = self.weight_sums
+        averaged_weights = []
+        for i, layer in enumerate(reference):
+            total = np.zeros(np.shape(layer), dtype=np.float64)
+            if self.weight_sums is not None:
+                total += self.weight_sums[i]
+            if self.delta_sums is not None:
+                total += self.sparse_samples * np.asarray(
+                    self.global_weights[i], dtype=np.float64
+                )
+                total += self.delta_sums[i]
+            total /= self.total_samples
+            dtype = layer.dtype if self.global_weights is not None else np.float32
+            averaged_weights.append(total.astype(dtype))
+        return averaged_weights
+
+
+class UpdateBuffer:
+    """
+    Keeps every client update of a round, for aggregators that need all of them
+    at once (e.g. coordinate-wise median). Memory is O(clients x model).
+    """
+
+    def __init__(self, global_weights: Optional[List[np.ndarray]] = None):
+        self.global_weights = global_weights
+        self.updates: List[List[np.ndarray]] = []
+        self.num_samples: List[float] = []
+
+    @property
+    def num_updates(self) -> int:
+        return len(self.updates)
+
+    def add(self, weights: Sequence[np.ndarray], num_samples: float = 1) -> None:
+        """Keep the full weights of one client"""
+        self.updates.append([np.asarray(layer, dtype=np.float32) for layer in weights])
+        self.num_samples.append(num_samples)
+
+    def add_sparse(self, deltas: Sequence[SparseDelta], num_samples: float = 1) -> None:
+        """Keep the weights of one client that sent a sparse delta"""
+        if self.global_weights is None:
+            raise ValueError("Sparse updates require the global weights")
+        weights = []
+        for layer, delta in zip(self.global_weights, deltas):
+            client_layer = np.array(layer, dtype=np.float32)
+            client_layer.reshape(-1)[delta.indices] += delta.values
+            weights.append(client_layer)
+        self.add(weights, num_samples)
+
+    def stacked(self, layer: int) -> np.ndarray:
+        """All client values of one layer, stacked along a new first axis"""
+        return np.stack([update[layer] for update in self.updates])
+
+    def result(self) -> List[np.ndarray]:
+        """Sample-weighted average of every update kept so far"""
+        accumulator = FedAvgAccumulator(self.global_weights)
+        for weights, num_samples in zip(self.updates, self.num_samples):
+            accumulator.add(weights, num_samples)
+        return accumulator.result()
+
+
+def average_sparse_deltas(
+    global_weights: List[np.ndarray],
+    client_deltas: Sequence[List[SparseDelta]],
+    client_weights: Sequence[List[np.ndarray]] = (),
+) -> List[np.ndarray]:
+    """Average client updates sent as sparse deltas onto the global weights.
+
+    The values of every sparse delta are scatter-added into a single dense
+    accumulator per layer, so client updates are never densified. Clients that
+    sent full weights instead are folded in as they are.
+    """
+    accumulator = FedAvgAccumulator(global_weights)
+    for deltas in client_deltas:
+        accumulator.add_sparse(deltas)
+    for weights in client_weights:
+        accumulator.add(weights)
+    return accumulator.result()
+
+
 def average_epoch_loss(losses: List[Tuple[float, int]]) -> float:
     """Compute weighted average of losses"""
     total_samples = sum(samples for _, samples in losses)
@@ -0,0 +1,56 @@
+"""Measured throughput of the devices of the network.
+
+Every completed evaluation task tells how many samples its device processed
+and how long the task took, from dispatch to response. The registry keeps an
+exponential moving average of that throughput per device, which the trainer
+uses to give faster devices larger shares of the evaluation data. Training
+tasks are not measured: devices run `batchSize` steps whatever their share,
+so a larger share does not take them longer.
+"""
+
+import statistics
+from typing import Dict, List, Optional
+
+
+class DeviceProfiles:
+    """
+    Samples per second of each device, smoothed over its past tasks.
+
+    `smoothing` is the weight of the latest measurement in the moving average.
+    """
+
+    def __init__(self, smoothing: float = 0.5):
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing must be in (0, 1], got %s" % smoothing)
+        self.smoothing = smoothing
+        self.throughputs: Dict[int, float] = {}
+
+    def __contains__(self, device_id: int) -> bool:
+        return device_id in self.throughputs
+
+    def record(self, device_id: int, num_samples: int, seconds: float) -> None:
+        """Fold the timing of one completed task into the device's profile"""
+        if num_samples <= 0 or seconds <= 0:
+            return
+        throughput = num_samples / seconds
+        if device_id in self.throughputs:
+            throughput = (
+                self.smoothing * throughput
+                + (1 - self.smoothing) * self.throughputs[device_id]
+            )
+        self.throughputs[device_id] = throughput
+
+    def throughput(self, device_id: int) -> Optional[float]:
+        """Samples per second of a device, None when it was never measured"""
+        return self.throughputs.get(device_id)
+
+    def capacities(self, device_ids: List[int]) -> List[float]:
+        """
+        Throughput of each device, for sizing its share of the data. Devices
+        that were never measured are assumed to be typical, i.e. to match the
+        median of the measured ones, and all devices count equally when none
+        was measured.
+        """
+        known = [self.throughputs[d] for d in device_ids if d in self.throughputs]
+        default = statistics.median(known) if known else 1.0
+        return [self.throughputs.get(d, default) for d in device_ids]
@@ -0,0 +1,17 @@
+"""Offline runs of a federated job on simulated phones.
+
+`SimulatedBackend` replaces the Supabase tables and realtime channels with
+in-memory ones, and answers tasks with simulated phones that execute them with
+keras the way the app does. Pass it as the trainer's backend to run a whole job
+on one machine:
+
+    from mfl.simulation import SimulatedBackend
+
+    backend = SimulatedBackend(num_devices=8)
+    trainer = Trainer(model, inputs, outputs, batch_size=2, backend=backend)
+    trainer.fit(epochs=3)
+    backend.shutdown()
+"""
+
+from .backend import SimulatedBackend, SimulatedDevice
+from .client import run_task
@@ -0,0 +1,209 @@
+"""In-memory network of simulated phones.
+
+`SimulatedBackend` is an `InMemoryBackend` whose devices answer the requests
+inserted for them, the way the app does (`app/src/communications`): a device
+marks itself busy, executes the task, marks itself available again and then
+inserts its response. Devices also heartbeat while they are connected.
+
+Each device runs one task at a time. Tasks run on a thread pool, or on a
+process pool with `processes=True`, so that devices train in parallel while
+the event loop keeps handling the worker's callbacks.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from ..artifacts import ArtifactCache
+from ..backend import InMemoryBackend
+from ..codec import (
+    BINARY_CODEC,
+    ENCODING_KEY,
+    ENVELOPE_MANIFEST_KEY,
+    BinaryCodec,
+    JsonCodec,
+    decode_tensors,
+    is_envelope,
+)
+from ..compression import TopKCompressor
+from .client import run_task
+
+HEARTBEAT_INTERVAL = 45  # seconds, as the app
+
+
+def _tensors(value) -> List[np.ndarray]:
+    """Tensors of a request field, sent as an envelope or as nested lists"""
+    if is_envelope(value):
+        return [np.asarray(t, dtype=np.float32) for t in decode_tensors(value)]
+    return [np.asarray(t, dtype=np.float32) for t in value]
+
+
+def _dataset(value, shape: Optional[List[int]]) -> Optional[np.ndarray]:
+    """Inputs or outputs of a request, as one array of the given shape"""
+    if value is None:
+        return None
+    data = _tensors(value)[0] if is_envelope(value) else np.asarray(value, np.float32)
+    return data.reshape(shape) if shape is not None else data
+
+
+class SimulatedDevice:
+    """
+    Device side state of a simulated phone: the artifacts and datasets it
+    holds and the residual of its top-k uploads.
+    """
+
+    def __init__(self, device_id: int, backend: "SimulatedBackend"):
+        self.id = device_id
+        self.backend = backend
+        self.artifacts = ArtifactCache(backend.store.get)
+        self.datasets: Dict[str, tuple] = {}
+        self.compressor: Optional[TopKCompressor] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.completed = 0
+        self.failed = 0
+
+    def decode_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Resolve the references of a request and decode its tensors"""
+        request = dict(data)
+        if request.get("modelJson") is None and request.get("modelRef"):
+            request["modelJson"] = self.artifacts.resolve(request["modelRef"])
+        weights = request.get("weights")
+        if weights is None and request.get("weightsRef"):
+            weights = self.artifacts.resolve(request["weightsRef"])
+        request["weights"] = _tensors(weights)
+        request["manifest"] = (
+            weights[ENVELOPE_MANIFEST_KEY] if is_envelope(weights) else None
+        )
+
+        inputs = _dataset(request.get("inputs"), request.get("inputShape"))
+        outputs = _dataset(request.get("outputs"), request.get("outputShape"))
+        dataset_ref = request.get("datasetRef")
+        if inputs is None and dataset_ref is not None:
+            # Only the reference of a partition the device holds was sent
+            inputs, outputs = self.datasets[dataset_ref]
+        elif dataset_ref is not None:
+            self.datasets[dataset_ref] = (inputs, outputs)
+        request["inputs"], request["outputs"] = inputs, outputs
+        return request
+
+    def encode_response(
+        self, data: Dict[str, Any], request: Dict[str, Any], response: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Encode the fields of a response with the codec of its request"""
+        fraction = request.get("topKFraction")
+        if fraction is not None and response.get("weights") is not None:
+            if self.compressor is None or self.compressor.fraction != fraction:
+                self.compressor = TopKCompressor(fraction)
+            response = dict(
+                response,
+                weights=None,
+                deltas=self.compressor.compress(response["weights"], request["weights"]),
+            )
+        if data.get(ENCODING_KEY) == BINARY_CODEC:
+            return BinaryCodec().encode_response(response, manifest=request["manifest"])
+        return JsonCodec().encode_response(response)
+
+    async def handle(self, record: Dict[str, Any]) -> None:
+        """Execute a task request and insert its response"""
+        async with self.lock:
+            if record["id"] not in self.backend.task_requests:
+                # Cancelled before the device picked it up
+                return
+            self.backend.set_device_status(self.id, "busy")
+            try:
+                request = self.decode_request(record["data"])
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(
+                    self.backend.executor,
+                    run_task,
+                    record["request_type"],
+                    {k: v for k, v in request.items() if k != "manifest"},
+                )
+                data = self.encode_response(record["data"], request, response)
+            except Exception as e:
+                print(f"Device {self.id} failed task {record['id']}: {e}")
+                self.failed += 1
+                self.backend.set_device_status(self.id, "available")
+                return
+            self.backend.set_device_status(self.id, "available")
+            self.completed += 1
+            self.backend.respond(record["id"], data)
+
+
+class SimulatedBackend(InMemoryBackend):
+    """
+    In-memory tables and realtime channels, and `num_devices` simulated phones
+    (ids 1 to `num_devices`) that are available from the start.
+
+    Tasks run on a pool of `max_workers` threads, or processes when
+    `processes` is set, unless an `executor` is given.
+    """
+
+    def __init__(
+        self,
+        num_devices: int,
+        max_workers: Optional[int] = None,
+        processes: bool = False,
+        executor: Optional[Executor] = None,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+    ):
+        super().__init__()
+        if executor is None and processes:
+            # Forked children would inherit TensorFlow's threads
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        elif executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="mfl-device"
+            )
+        self.executor = executor
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat: Optional[asyncio.Task] = None
+        self.running: Set[asyncio.Task] = set()
+        self.simulated_devices = {
+            device_id: SimulatedDevice(device_id, self)
+            for device_id in range(1, num_devices + 1)
+        }
+        for device_id in self.simulated_devices:
+            self.set_device_status(device_id, "available")
+
+    async def connect(self, on_device_update, on_task_response, on_reconnect=None) -> None:
+        await super().connect(on_device_update, on_task_response, on_reconnect)
+        # Locks and the heartbeat belong to the event loop of the session
+        for device in self.simulated_devices.values():
+            device.lock = asyncio.Lock()
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            for device_id in self.simulated_devices:
+                self.set_device_status(device_id, "available")
+
+    async def close(self) -> None:
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        for task in list(self.running):
+            task.cancel()
+        await super().close()
+
+    async def insert_task_requests(self, rows: List[Dict]) -> List[Dict]:
+        records = await super().insert_task_requests(rows)
+        loop = asyncio.get_running_loop()
+        for record in records:
+            device = self.simulated_devices.get(record["device_id"])
+            if device is not None and device.lock is not None:
+                task = loop.create_task(device.handle(record))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+        return records
+
+    def shutdown(self) -> None:
+        """Stop the pool the devices run their tasks on"""
+        self.executor.shutdown(wait=True)
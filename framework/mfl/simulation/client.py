@@ -0,0 +1,215 @@
+"""Task execution of a simulated phone.
+
+Mirrors the ML code of the app (`app/src/ml`) with keras instead of
+TensorFlow.js, on requests whose fields have already been decoded:
+  - the model is rebuilt from the topology of `modelJson` and compiled with the
+    optimizer and loss of its training config, with the app's defaults
+    (`Optimizers.ts`, `Losses.ts`).
+  - training (`Training.ts`) runs `batchSize` iterations over micro-batches of
+    one sample, accumulates their gradients and applies their average once.
+    `epochs` is ignored, as on the app. The reported loss is the average over
+    the iterations that ran.
+  - evaluation (`Evaluation.ts`) and prediction (`Prediction.ts`) run in
+    batches of `batchSize`. Predictions are returned per batch.
+
+Every response carries the weights of the model, as `processSendConfig` does.
+
+Functions of this module only take and return numpy arrays and plain values,
+so that tasks can run in a thread or a process pool. Models are cached per
+thread and per topology.
+"""
+
+import json
+import threading
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import tensorflow as tf
+import tf_keras as keras
+
+from ..artifacts import content_hash
+
+_cache = threading.local()
+
+
+def _losses() -> Dict[str, Callable]:
+    return {
+        "mean_squared_error": keras.losses.MeanSquaredError(),
+        "mse": keras.losses.MeanSquaredError(),
+        "mean_absolute_error": keras.losses.MeanAbsoluteError(),
+        "mae": keras.losses.MeanAbsoluteError(),
+        "categorical_crossentropy": keras.losses.CategoricalCrossentropy(),
+        "binary_crossentropy": keras.losses.BinaryCrossentropy(),
+        "sparse_categorical_crossentropy": keras.losses.SparseCategoricalCrossentropy(),
+        "hinge": keras.losses.Hinge(),
+        "huber_loss": keras.losses.Huber(delta=1.0),
+        "kl_divergence": keras.losses.KLDivergence(),
+        "cosine_similarity": keras.losses.CosineSimilarity(axis=-1),
+    }
+
+
+def create_loss_function(model_json: Dict) -> Callable:
+    """Loss function of the model's training config, as `Losses.ts` maps it"""
+    loss = model_json["modelTopology"].get("training_config", {}).get("loss")
+    if not loss:
+        raise ValueError("Loss function not found in the model JSON.")
+    losses = _losses()
+    if not isinstance(loss, str) or loss.lower() not in losses:
+        raise ValueError("Unsupported loss function: %s" % loss)
+    return losses[loss.lower()]
+
+
+def create_optimizer(model_json: Dict) -> keras.optimizers.Optimizer:
+    """Optimizer of the model's training config, as `Optimizers.ts` builds it"""
+    optimizer_config = (
+        model_json["modelTopology"].get("training_config", {}).get("optimizer_config")
+    )
+    if not optimizer_config:
+        raise ValueError("Optimizer configuration not found in the model JSON.")
+    # Keras serializes its built-in optimizers as e.g. `Custom>SGD`
+    class_name = optimizer_config["class_name"].split(">")[-1].lower()
+    config = optimizer_config.get("config", {})
+
+    if class_name == "sgd":
+        return keras.optimizers.SGD(
+            learning_rate=config.get("learning_rate", 0.01),
+            momentum=config.get("momentum", 0.9),
+        )
+    if class_name == "adam":
+        return keras.optimizers.Adam(
+            learning_rate=config.get("learning_rate", 0.001),
+            beta_1=config.get("beta_1", 0.9),
+            beta_2=config.get("beta_2", 0.999),
+            epsilon=config.get("epsilon", 1e-8),
+        )
+    if class_name == "rmsprop":
+        return keras.optimizers.RMSprop(
+            learning_rate=config.get("learning_rate", 0.01),
+            rho=config.get("rho", 0.9),
+            momentum=config.get("momentum", 0.0),
+            epsilon=config.get("epsilon", 1e-7),
+            centered=config.get("centered", False),
+        )
+    raise ValueError("Unsupported optimizer class name: %s" % optimizer_config["class_name"])
+
+
+def load_model(model_json: Dict, weights: List[np.ndarray]) -> keras.Model:
+    """
+    Model of the given topology holding the given weights. Models are built
+    once per thread and topology, later tasks only set their weights.
+    """
+    models = getattr(_cache, "models", None)
+    if models is None:
+        models = _cache.models = {}
+    key = content_hash(model_json["modelTopology"]["model_config"])
+    if key not in models:
+        models[key] = keras.models.model_from_json(
+            json.dumps(model_json["modelTopology"]["model_config"])
+        )
+    model = models[key]
+    model.set_weights(weights)
+    return model
+
+
+def _proximal_term(model: keras.Model, anchor: List[tf.Tensor], mu: float) -> tf.Tensor:
+    """FedProx penalty mu / 2 * ||w - w_global||^2 over the trainable weights"""
+    return 0.5 * mu * tf.add_n(
+        [tf.reduce_sum(tf.square(w - w0)) for w, w0 in zip(model.trainable_weights, anchor)]
+    )
+
+
+def run_training(model: keras.Model, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Accumulate the gradients of `batchSize` single samples and apply them once"""
+    loss_function = create_loss_function(request["modelJson"])
+    optimizer = create_optimizer(request["modelJson"])
+    inputs, outputs = request["inputs"], request["outputs"]
+    accumulation_steps = request["batchSize"]
+    total_iterations = request["batchSize"]
+    num_samples = len(inputs)
+    mu = request.get("proximalMu")
+    anchor = [tf.identity(w) for w in model.trainable_weights] if mu else None
+
+    def apply(accumulated, steps):
+        optimizer.apply_gradients(
+            [(g / steps, w) for g, w in zip(accumulated, model.trainable_weights)]
+        )
+
+    accumulated = [tf.zeros_like(w) for w in model.trainable_weights]
+    total_loss = 0.0
+    step = 0
+    iteration = 0
+    while iteration < total_iterations:
+        for sample in range(num_samples):
+            if iteration >= total_iterations:
+                break
+            with tf.GradientTape() as tape:
+                predictions = model(inputs[sample : sample + 1], training=True)
+                loss = loss_function(outputs[sample : sample + 1], predictions)
+                objective = loss if not mu else loss + _proximal_term(model, anchor, mu)
+            grads = tape.gradient(objective, model.trainable_weights)
+            total_loss += float(loss)
+            accumulated = [
+                a + g if g is not None else a for a, g in zip(accumulated, grads)
+            ]
+            step += 1
+            iteration += 1
+            if step % accumulation_steps == 0:
+                apply(accumulated, accumulation_steps)
+                accumulated = [tf.zeros_like(w) for w in model.trainable_weights]
+
+    if step % accumulation_steps != 0:
+        apply(accumulated, step % accumulation_steps)
+
+    return {
+        "weights": model.get_weights(),
+        "loss": total_loss / max(step, 1),
+    }
+
+
+def run_evaluation(model: keras.Model, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Average loss over the data, evaluated `batchSize` samples at a time"""
+    loss_function = create_loss_function(request["modelJson"])
+    inputs, outputs = request["inputs"], request["outputs"]
+    batch_size = request["batchSize"]
+    total_loss = 0.0
+    for start in range(0, len(inputs), batch_size):
+        end = min(start + batch_size, len(inputs))
+        predictions = model(inputs[start:end], training=False)
+        total_loss += float(loss_function(outputs[start:end], predictions)) * (end - start)
+    return {
+        "weights": model.get_weights(),
+        "loss": total_loss / max(len(inputs), 1),
+    }
+
+
+def run_prediction(model: keras.Model, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Predictions of every batch of `batchSize` samples"""
+    inputs = request["inputs"]
+    batch_size = request["batchSize"]
+    predictions = [
+        model(inputs[start : start + batch_size], training=False).numpy()
+        for start in range(0, len(inputs), batch_size)
+    ]
+    return {
+        "weights": model.get_weights(),
+        "outputs": predictions,
+        "loss": 0,
+    }
+
+
+TASKS = {
+    "train": run_training,
+    "evaluate": run_evaluation,
+    "predict": run_prediction,
+}
+
+
+def run_task(request_type: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Execute a decoded request as the app would and return the fields of its
+    response
+    """
+    if request_type not in TASKS:
+        raise ValueError("Unhandled task type: %s" % request_type)
+    model = load_model(request["modelJson"], request["weights"])
+    return TASKS[request_type](model, request)
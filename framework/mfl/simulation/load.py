@@ -0,0 +1,315 @@
+"""Load harness for the coordinator.
+
+Runs training rounds of a `Trainer` against thousands of virtual devices, to
+find where the worker, its task manager and the aggregation of responses stop
+keeping up. Virtual devices do not run a model: each task is answered with a
+canned response (the weights it was sent) after a latency drawn from a
+configurable distribution, and a configurable fraction of tasks is never
+answered.
+
+Every round reports:
+  - dispatch rate: task requests inserted per second.
+  - callback throughput: responses handled per second of time spent in the
+    worker's response callback.
+  - event loop lag: how late a 10 ms timer fires, max and 99th percentile.
+  - coordinator memory: resident set size after the round, and its peak.
+
+With `--trace`, a Chrome trace of the run (see `mfl.tracing`) is written too.
+
+Usage:
+
+    python -m mfl.simulation.load --devices 1000 10000 50000 --rounds 3 \\
+        --latency lognormal:0,0.5 --failure-rate 0.01 --deadline 30
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import resource
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import tf_keras as keras
+
+from ..backend import InMemoryBackend, _realtime_payload
+from ..tracing import Tracer
+from ..trainer import Trainer
+from ..worker import RoundPolicy
+
+LAG_INTERVAL = 0.01  # seconds between event loop lag probes
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Latency distribution from a spec: `constant:s`, `uniform:low,high`,
+    `exponential:mean` or `lognormal:mu,sigma` (in seconds)
+    """
+    name, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if name == "constant" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(*values)
+    if name == "exponential" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0])
+    if name == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(*values)
+    raise ValueError("Unsupported latency distribution %r" % spec)
+
+
+def rss_bytes() -> int:
+    """Current resident set size of the process"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class VirtualDeviceBackend(InMemoryBackend):
+    """
+    In-memory backend whose `num_devices` virtual devices answer every task
+    with the weights it was sent, after `latency(rng)` seconds. A
+    `failure_rate` fraction of tasks is never answered, and every insert
+    takes `insert_latency` seconds, like a round trip to the database.
+
+    Responses are delivered without being stored, so that memory measures
+    the coordinator only.
+    """
+
+    def __init__(
+        self,
+        num_devices: int,
+        latency: Callable[[random.Random], float] = lambda rng: 0.0,
+        failure_rate: float = 0.0,
+        insert_latency: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        super().__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.insert_latency = insert_latency
+        self.rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        for device_id in range(1, num_devices + 1):
+            self.devices[device_id] = {
+                "id": device_id,
+                "status": "available",
+                "last_updated": now,
+            }
+        self.inserted = 0
+        self.inserted_at = 0.0
+        self.callbacks = 0
+        self.callback_seconds = 0.0
+
+    async def insert_task_requests(self, rows: List[Dict]) -> List[Dict]:
+        if self.insert_latency:
+            await asyncio.sleep(self.insert_latency)
+        records = await super().insert_task_requests(rows)
+        loop = asyncio.get_running_loop()
+        for record in records:
+            if self.rng.random() >= self.failure_rate:
+                loop.call_later(self.latency(self.rng), self._answer, record)
+        self.inserted += len(records)
+        self.inserted_at = time.perf_counter()
+        return records
+
+    def _answer(self, record: Dict) -> None:
+        if self.task_requests.pop(record["id"], None) is None:
+            # Cancelled before the device answered
+            return
+        data = {"weights": record["data"]["weights"], "loss": 1.0}
+        if "encoding" in record["data"]:
+            data["encoding"] = record["data"]["encoding"]
+        payload = _realtime_payload({"id": record["id"], "data": data})
+        started = time.perf_counter()
+        self.on_task_response(payload)
+        self.callback_seconds += time.perf_counter() - started
+        self.callbacks += 1
+
+
+@dataclass
+class RoundReport:
+    devices: int
+    tasks: int
+    responses: int
+    round_seconds: float
+    dispatch_seconds: float
+    dispatch_rate: float
+    callback_rate: float
+    gather_seconds: float
+    loop_lag_max: float
+    loop_lag_p99: float
+    rss_mb: float
+    peak_rss_mb: float
+
+
+async def _probe_lag(lags: List[float]) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - started - LAG_INTERVAL))
+
+
+async def _run_rounds(
+    trainer: Trainer, backend: VirtualDeviceBackend, rounds: int
+) -> List[RoundReport]:
+    reports = []
+    worker = trainer.worker
+    async with worker.session():
+        for _ in range(rounds):
+            request_config = await trainer._create_base_request_config()
+            devices = await worker.load_available_devices()
+            datasets = trainer._split(trainer.inputs, devices, trainer.outputs)
+            inserted, callbacks = backend.inserted, backend.callbacks
+            callback_seconds = backend.callback_seconds
+
+            lags: List[float] = []
+            probe = asyncio.create_task(_probe_lag(lags))
+            started = time.perf_counter()
+            try:
+                await trainer._dispatch(request_config, datasets, "train")
+            finally:
+                probe.cancel()
+            dispatched = time.perf_counter()
+            trainer._gather("train")
+            gathered = time.perf_counter()
+
+            tasks = backend.inserted - inserted
+            responses = backend.callbacks - callbacks
+            # Until the last request of the round was inserted
+            dispatch_seconds = backend.inserted_at - started
+            spent = backend.callback_seconds - callback_seconds
+            lags.sort()
+            reports.append(
+                RoundReport(
+                    devices=len(devices),
+                    tasks=tasks,
+                    responses=responses,
+                    round_seconds=gathered - started,
+                    dispatch_seconds=dispatch_seconds,
+                    dispatch_rate=tasks / dispatch_seconds if dispatch_seconds else 0.0,
+                    callback_rate=responses / spent if spent else 0.0,
+                    gather_seconds=gathered - dispatched,
+                    loop_lag_max=lags[-1] if lags else 0.0,
+                    loop_lag_p99=lags[int(0.99 * (len(lags) - 1))] if lags else 0.0,
+                    rss_mb=rss_bytes() / 2**20,
+                    peak_rss_mb=peak_rss_bytes() / 2**20,
+                )
+            )
+    return reports
+
+
+def run_load(
+    num_devices: int,
+    rounds: int = 3,
+    latency: Callable[[random.Random], float] = lambda rng: 0.0,
+    failure_rate: float = 0.0,
+    insert_latency: float = 0.0,
+    units: int = 16,
+    samples_per_device: int = 1,
+    deadline: float = 30.0,
+    codec: Optional[str] = None,
+    seed: Optional[int] = None,
+    trace: Optional[str] = None,
+) -> List[RoundReport]:
+    """
+    Run `rounds` training rounds on `num_devices` virtual devices, with a
+    dense model of `units` inputs and outputs, and report each one. With
+    `trace`, the Chrome trace of the run is written to that path.
+    """
+    backend = VirtualDeviceBackend(
+        num_devices,
+        latency=latency,
+        failure_rate=failure_rate,
+        insert_latency=insert_latency,
+        seed=seed,
+    )
+    model = keras.Sequential(
+        [keras.layers.Input(shape=(units,)), keras.layers.Dense(units)]
+    )
+    model.compile(optimizer="sgd", loss="mean_squared_error")
+    num_samples = num_devices * samples_per_device
+    rng = np.random.default_rng(seed)
+    trainer = Trainer(
+        model,
+        rng.random((num_samples, units), dtype=np.float32),
+        rng.random((num_samples, units), dtype=np.float32),
+        batch_size=1,
+        codec=codec,
+        round_policy=RoundPolicy(deadline=deadline),
+        backend=backend,
+        tracer=Tracer(trace) if trace else None,
+    )
+    try:
+        return asyncio.run(_run_rounds(trainer, backend, rounds))
+    finally:
+        if trainer.tracer is not None:
+            trainer.tracer.write()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", default="uniform:0.5,2", help="latency distribution")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--insert-latency", type=float, default=0.0)
+    parser.add_argument("--units", type=int, default=16, help="model width, sets payload size")
+    parser.add_argument("--deadline", type=float, default=30.0)
+    parser.add_argument("--codec", choices=["json", "binary"], default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="write the reports to this JSON file")
+    parser.add_argument(
+        "--trace", help="write a Chrome trace of each run, {devices} is replaced"
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    for num_devices in args.devices:
+        reports = run_load(
+            num_devices,
+            rounds=args.rounds,
+            latency=parse_latency(args.latency),
+            failure_rate=args.failure_rate,
+            insert_latency=args.insert_latency,
+            units=args.units,
+            deadline=args.deadline,
+            codec=args.codec,
+            seed=args.seed,
+            trace=args.trace.format(devices=num_devices) if args.trace else None,
+        )
+        for index, report in enumerate(reports):
+            print(
+                f"devices={num_devices} round={index + 1} "
+                f"responses={report.responses}/{report.tasks} "
+                f"round={report.round_seconds:.2f}s "
+                f"dispatch={report.dispatch_rate:.0f}/s "
+                f"callbacks={report.callback_rate:.0f}/s "
+                f"gather={report.gather_seconds:.3f}s "
+                f"lag_max={report.loop_lag_max * 1000:.1f}ms "
+                f"lag_p99={report.loop_lag_p99 * 1000:.1f}ms "
+                f"rss={report.rss_mb:.0f}MB peak={report.peak_rss_mb:.0f}MB"
+            )
+            results.append(dict(asdict(report), round=index + 1))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Server-side aggregation strategies.
+
+A strategy decides how the client updates of a round are combined into the
+next global weights. For every round the `Trainer` asks the strategy for an
+accumulator (`begin_round`), folds every client update into it as it arrives,
+and finally asks the strategy for the new global weights (`aggregate`).
+
+Available strategies:
+  - `fedavg`: sample-weighted average of the client weights (FedAvg).
+  - `fedprox`: FedAvg aggregation, with a proximal term `mu` sent to devices so
+    that local training stays close to the global weights (FedProx).
+  - `fedavgm`, `fedadam`, `fedyogi`: the sample-weighted average is turned into
+    a pseudo-gradient (average - global weights) and applied with a server
+    optimizer: momentum, Adam or Yogi (Reddi et al., Adaptive Federated
+    Optimization).
+  - `trimmed_mean`, `median`: coordinate-wise robust statistics over all
+    client weights, computed with vectorized numpy over the stacked updates.
+"""
+
+from abc import ABCMeta, abstractmethod
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .federated import FedAvgAccumulator, UpdateBuffer
+
+
+class FedAvg:
+    """Sample-weighted average of the client weights"""
+
+    name = "fedavg"
+
+    def begin_round(self, global_weights: List[np.ndarray]):
+        """Create the accumulator client updates of a round are folded into"""
+        return FedAvgAccumulator(global_weights)
+
+    def aggregate(self, accumulator) -> List[np.ndarray]:
+        """Compute the next global weights from a round's accumulator"""
+        return accumulator.result()
+
+    def request_options(self) -> Dict:
+        """Extra request config fields devices need for this strategy"""
+        return {}
+
+
+class FedProx(FedAvg):
+    """
+    FedAvg aggregation with a proximal term `mu / 2 * ||w - w_global||^2` added
+    to the local objective of each device.
+    """
+
+    name = "fedprox"
+
+    def __init__(self, mu: float = 0.01):
+        if mu < 0:
+            raise ValueError("FedProx mu must be non-negative, got %s" % mu)
+        self.mu = mu
+
+    def request_options(self) -> Dict:
+        return {"proximalMu": self.mu}
+
+
+class ServerOptimizer(FedAvg, metaclass=ABCMeta):
+    """
+    Applies the averaged client update as a pseudo-gradient with a server-side
+    optimizer. Subclasses implement `step` on one layer.
+    """
+
+    def __init__(self, learning_rate: float):
+        self.learning_rate = learning_rate
+        self.state: Optional[List[Dict[str, np.ndarray]]] = None
+
+    @abstractmethod
+    def step(self, state: Dict[str, np.ndarray], delta: np.ndarray) -> np.ndarray:
+        """Update of one layer for its averaged client `delta`, keeping `state`"""
+
+    def aggregate(self, accumulator) -> List[np.ndarray]:
+        global_weights = accumulator.global_weights
+        averaged_weights = accumulator.result()
+        if self.state is None:
+            self.state = [{} for _ in global_weights]
+
+        new_weights = []
+        for state, global_layer, averaged_layer in zip(
+            self.state, global_weights, averaged_weights
+        ):
+            delta = averaged_layer.astype(np.float64) - global_layer
+            update = self.step(state, delta)
+            new_weights.append((global_layer + update).astype(global_layer.dtype))
+        return new_weights
+
+
+class FedAvgM(ServerOptimizer):
+    """Server momentum on the averaged client update"""
+
+    name = "fedavgm"
+
+    def __init__(self, learning_rate: float = 1.0, momentum: float = 0.9):
+        super().__init__(learning_rate)
+        self.momentum = momentum
+
+    def step(self, state, delta):
+        velocity = state.get("velocity", np.zeros_like(delta))
+        velocity = self.momentum * velocity + delta
+        state["velocity"] = velocity
+        return self.learning_rate * velocity
+
+
+class FedAdam(ServerOptimizer):
+    """Adam on the averaged client update"""
+
+    name = "fedadam"
+
+    def __init__(
+        self,
+        learning_rate: float = 0.01,
+        beta_1: float = 0.9,
+        beta_2: float = 0.99,
+        tau: float = 1e-3,
+    ):
+        super().__init__(learning_rate)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.tau = tau
+
+    def second_moment(self, v: np.ndarray, delta: np.ndarray) -> np.ndarray:
+        return self.beta_2 * v + (1 - self.beta_2) * np.square(delta)
+
+    def step(self, state, delta):
+        m = state.get("m", np.zeros_like(delta))
+        v = state.get("v", np.full_like(delta, self.tau**2))
+        m = self.beta_1 * m + (1 - self.beta_1) * delta
+        v = self.second_moment(v, delta)
+        state["m"], state["v"] = m, v
+        return self.learning_rate * m / (np.sqrt(v) + self.tau)
+
+
+class FedYogi(FedAdam):
+    """Yogi on the averaged client update"""
+
+    name = "fedyogi"
+
+    def second_moment(self, v: np.ndarray, delta: np.ndarray) -> np.ndarray:
+        delta_squared = np.square(delta)
+        return v - (1 - self.beta_2) * delta_squared * np.sign(v - delta_squared)
+
+
+class TrimmedMean(FedAvg):
+    """
+    Coordinate-wise trimmed mean: for every coordinate, the `trim_ratio`
+    largest and smallest client values are dropped before averaging.
+    """
+
+    name = "trimmed_mean"
+
+    def __init__(self, trim_ratio: float = 0.1):
+        if not 0 <= trim_ratio < 0.5:
+            raise ValueError("trim_ratio must be in [0, 0.5), got %s" % trim_ratio)
+        self.trim_ratio = trim_ratio
+
+    def begin_round(self, global_weights):
+        return UpdateBuffer(global_weights)
+
+    def reduce(self, stacked: np.ndarray) -> np.ndarray:
+        num_clients = stacked.shape[0]
+        trim = int(num_clients * self.trim_ratio)
+        if trim == 0:
+            return stacked.mean(axis=0)
+        stacked = np.sort(stacked, axis=0)
+        return stacked[trim : num_clients - trim].mean(axis=0)
+
+    def aggregate(self, accumulator) -> List[np.ndarray]:
+        return [
+            self.reduce(accumulator.stacked(layer)).astype(np.float32)
+            for layer in range(len(accumulator.updates[0]))
+        ]
+
+
+class Median(TrimmedMean):
+    """Coordinate-wise median of the client weights"""
+
+    name = "median"
+
+    def __init__(self):
+        super().__init__(trim_ratio=0.0)
+
+    def reduce(self, stacked: np.ndarray) -> np.ndarray:
+        return np.median(stacked, axis=0)
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (FedAvg, FedProx, FedAvgM, FedAdam, FedYogi, TrimmedMean, Median)
+}
+
+
+def get_strategy(strategy=None):
+    """Create the strategy registered under a name, or pass an instance through"""
+    if strategy is None:
+        return FedAvg()
+    if isinstance(strategy, str):
+        if strategy not in STRATEGIES:
+            raise ValueError(
+                "Unsupported strategy %r, expected one of %s"
+                % (strategy, ", ".join(STRATEGIES))
+            )
+        return STRATEGIES[strategy]()
+    return strategy
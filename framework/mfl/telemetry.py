@@ -0,0 +1,263 @@
+"""Per-round metrics of a federated job.
+
+Every round of a `Trainer` (a training, evaluation or prediction dispatch)
+records a `RoundMetrics`: how long each stage took, how many bytes went to
+and came from each device, how many devices answered, and the latency of each
+response. Stages are:
+  - split: partitioning the data across devices.
+  - serialize: encoding task requests.
+  - dispatch: inserting task requests.
+  - first_response, last_response: time from the start of the dispatch to
+    the first and to the last response.
+  - deserialize: decoding responses and their weights.
+  - aggregate: folding responses into the round aggregate and reducing it.
+  - set_weights: loading the aggregate into the model.
+
+Rounds are kept on `Trainer.telemetry`, and can be exported as JSON lines or
+in the Prometheus text exposition format.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+STAGES = (
+    "split",
+    "serialize",
+    "dispatch",
+    "first_response",
+    "last_response",
+    "deserialize",
+    "aggregate",
+    "set_weights",
+)
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def payload_size(payload: Any) -> int:
+    """Bytes of a payload once JSON encoded, as it is sent to the database"""
+    return len(json.dumps(payload, separators=(",", ":")).encode())
+
+
+@dataclass
+class RoundMetrics:
+    """Stage timings, byte counts and response latencies of one round"""
+
+    round: int
+    request_type: str
+    started_at: float = field(default_factory=time.time)
+    count_bytes: bool = False
+    stages: Dict[str, float] = field(default_factory=lambda: dict.fromkeys(STAGES, 0.0))
+    dispatched: int = 0
+    responded: int = 0
+    expired: int = 0
+    cancelled: int = 0
+    bytes_sent: Dict[int, int] = field(default_factory=dict)
+    bytes_received: Dict[int, int] = field(default_factory=dict)
+    latencies: List[float] = field(default_factory=list)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Add the time spent in the block to a stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def sent(self, device_id: int, payload: Any) -> None:
+        if self.count_bytes:
+            self.bytes_sent[device_id] = self.bytes_sent.get(device_id, 0) + payload_size(
+                payload
+            )
+
+    def received(self, device_id: int, payload: Any) -> None:
+        if self.count_bytes:
+            self.bytes_received[device_id] = self.bytes_received.get(
+                device_id, 0
+            ) + payload_size(payload)
+
+    def responded_after(self, seconds: float) -> None:
+        """Record a response arriving `seconds` after the start of the dispatch"""
+        if not self.responded:
+            self.stages["first_response"] = seconds
+        self.stages["last_response"] = seconds
+        self.responded += 1
+
+    def latency_percentiles(self) -> Dict[str, float]:
+        if not self.latencies:
+            return {}
+        values = np.percentile(self.latencies, [100 * q for q in LATENCY_QUANTILES])
+        percentiles = {f"p{int(100 * q)}": float(v) for q, v in zip(LATENCY_QUANTILES, values)}
+        percentiles["max"] = float(max(self.latencies))
+        return percentiles
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "round": self.round,
+            "request_type": self.request_type,
+            "started_at": self.started_at,
+            "stages": dict(self.stages),
+            "dispatched": self.dispatched,
+            "responded": self.responded,
+            "expired": self.expired,
+            "cancelled": self.cancelled,
+            "bytes_sent": sum(self.bytes_sent.values()),
+            "bytes_received": sum(self.bytes_received.values()),
+            "bytes_sent_per_device": {str(k): v for k, v in self.bytes_sent.items()},
+            "bytes_received_per_device": {
+                str(k): v for k, v in self.bytes_received.items()
+            },
+            "latency": self.latency_percentiles(),
+        }
+
+
+class Telemetry:
+    """
+    Metrics of the rounds of a job, most recent last.
+
+    Only the last `max_rounds` rounds are kept (all of them when None). With a
+    `jsonl_path`, every round is appended to that file once it ends. Bytes are
+    only counted with `count_bytes`, since it encodes every payload a second
+    time, which is costly for payloads of the json codec.
+    """
+
+    def __init__(
+        self,
+        jsonl_path: Optional[str] = None,
+        max_rounds: Optional[int] = 1000,
+        count_bytes: bool = False,
+    ):
+        self.jsonl_path = jsonl_path
+        self.max_rounds = max_rounds
+        self.count_bytes = count_bytes
+        self.rounds: List[RoundMetrics] = []
+        self.current: Optional[RoundMetrics] = None
+        self.num_rounds = 0
+        self.totals: Dict[str, float] = {
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "dispatched": 0,
+            "responded": 0,
+            "expired": 0,
+            "cancelled": 0,
+        }
+
+    def begin_round(self, request_type: str) -> RoundMetrics:
+        """Start recording a new round"""
+        self.num_rounds += 1
+        self.current = RoundMetrics(
+            round=self.num_rounds,
+            request_type=request_type,
+            count_bytes=self.count_bytes,
+        )
+        return self.current
+
+    def end_round(self) -> Optional[RoundMetrics]:
+        """Keep the current round, and append it to the JSON lines file if any"""
+        metrics, self.current = self.current, None
+        if metrics is None:
+            return None
+        self.rounds.append(metrics)
+        if self.max_rounds is not None and len(self.rounds) > self.max_rounds:
+            del self.rounds[: len(self.rounds) - self.max_rounds]
+        self.totals["bytes_sent"] += sum(metrics.bytes_sent.values())
+        self.totals["bytes_received"] += sum(metrics.bytes_received.values())
+        for key in ("dispatched", "responded", "expired", "cancelled"):
+            self.totals[key] += getattr(metrics, key)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(metrics.to_dict()) + "\n")
+        return metrics
+
+    @property
+    def latest(self) -> Optional[RoundMetrics]:
+        return self.rounds[-1] if self.rounds else None
+
+    def write_jsonl(self, path: str) -> None:
+        """Write every kept round as one JSON object per line"""
+        with open(path, "w") as f:
+            for metrics in self.rounds:
+                f.write(json.dumps(metrics.to_dict()) + "\n")
+
+    def prometheus(self) -> str:
+        """
+        Totals of the job and the metrics of the latest round of each request
+        type, in the Prometheus text exposition format
+        """
+        latest: Dict[str, RoundMetrics] = {}
+        for metrics in self.rounds:
+            latest[metrics.request_type] = metrics
+
+        lines = [
+            "# HELP mfl_rounds_total Rounds recorded.",
+            "# TYPE mfl_rounds_total counter",
+            f"mfl_rounds_total {self.num_rounds}",
+            "# HELP mfl_bytes_total Payload bytes exchanged with devices.",
+            "# TYPE mfl_bytes_total counter",
+            f'mfl_bytes_total{{direction="sent"}} {self.totals["bytes_sent"]}',
+            f'mfl_bytes_total{{direction="received"}} {self.totals["bytes_received"]}',
+            "# HELP mfl_tasks_total Tasks by outcome.",
+            "# TYPE mfl_tasks_total counter",
+        ]
+        for key in ("dispatched", "responded", "expired", "cancelled"):
+            lines.append(f'mfl_tasks_total{{state="{key}"}} {self.totals[key]}')
+
+        lines += [
+            "# HELP mfl_round_stage_seconds Time spent in each stage of the latest round.",
+            "# TYPE mfl_round_stage_seconds gauge",
+        ]
+        for request_type, metrics in latest.items():
+            for stage, seconds in metrics.stages.items():
+                lines.append(
+                    f'mfl_round_stage_seconds{{request_type="{request_type}",'
+                    f'stage="{stage}"}} {seconds}'
+                )
+        lines += [
+            "# HELP mfl_round_tasks Tasks of the latest round by outcome.",
+            "# TYPE mfl_round_tasks gauge",
+        ]
+        for request_type, metrics in latest.items():
+            for key in ("dispatched", "responded", "expired", "cancelled"):
+                lines.append(
+                    f'mfl_round_tasks{{request_type="{request_type}",state="{key}"}} '
+                    f"{getattr(metrics, key)}"
+                )
+        lines += [
+            "# HELP mfl_round_bytes Payload bytes of the latest round.",
+            "# TYPE mfl_round_bytes gauge",
+        ]
+        for request_type, metrics in latest.items():
+            for direction, counts in (
+                ("sent", metrics.bytes_sent),
+                ("received", metrics.bytes_received),
+            ):
+                lines.append(
+                    f'mfl_round_bytes{{request_type="{request_type}",'
+                    f'direction="{direction}"}} {sum(counts.values())}'
+                )
+        lines += [
+            "# HELP mfl_round_latency_seconds Response latency of the latest round.",
+            "# TYPE mfl_round_latency_seconds summary",
+        ]
+        for request_type, metrics in latest.items():
+            percentiles = metrics.latency_percentiles()
+            for q in LATENCY_QUANTILES:
+                if percentiles:
+                    lines.append(
+                        f'mfl_round_latency_seconds{{request_type="{request_type}",'
+                        f'quantile="{q}"}} {percentiles[f"p{int(100 * q)}"]}'
+                    )
+            lines.append(
+                f'mfl_round_latency_seconds_sum{{request_type="{request_type}"}} '
+                f"{sum(metrics.latencies)}"
+            )
+            lines.append(
+                f'mfl_round_latency_seconds_count{{request_type="{request_type}"}} '
+                f"{len(metrics.latencies)}"
+            )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+"""Timeline traces of a federated job.
+
+A `Tracer` records spans in the Chrome trace event format, which opens in
+Perfetto (ui.perfetto.dev) and in chrome://tracing. Where `Telemetry` sums the
+time of each stage of a round, a trace shows when each task ran, so that
+stragglers, serialization stalls and a blocked event loop stand out.
+
+The coordinator process has a `trainer` track, with the phases of the job
+(fit, epochs, rounds, split, dispatch, aggregation...), and a `worker` track,
+with the serialization and insertion of task requests. The devices process
+has one track per device, where each task is a sequence of spans ending at
+the moment the task was:
+  - sent: its request was inserted.
+  - accepted: the device reported itself busy (the `queued` span).
+  - answered: its response was received (a span named after the request type).
+  - decoded: its response was decoded.
+  - merged: its response was handed to the trainer.
+Tasks that never answer end with an `expired` or `cancelled` instant event.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+COORDINATOR_PID = 1
+DEVICES_PID = 2
+TRAINER_TRACK = "trainer"
+WORKER_TRACK = "worker"
+
+
+class Tracer:
+    """
+    Trace events of a job. Events are kept in memory and written with `write`,
+    to `path` unless another one is given.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.origin = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.tracks: Dict[str, int] = {}
+        self.devices = set()
+        # Open span of each task, as (start, name, request type)
+        self.task_spans: Dict[int, Tuple[float, str, str]] = {}
+        # Task each device was last sent and has not accepted yet
+        self.device_tasks: Dict[int, int] = {}
+        self._metadata("process_name", COORDINATOR_PID, 0, "coordinator")
+        self._metadata("process_name", DEVICES_PID, 0, "devices")
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def _metadata(self, name: str, pid: int, tid: int, label: str) -> None:
+        self.events.append(
+            {"name": name, "ph": "M", "pid": pid, "tid": tid, "args": {"name": label}}
+        )
+
+    def _track(self, track) -> Tuple[int, int]:
+        """Process and thread ids of a named coordinator track or of a device"""
+        if isinstance(track, str):
+            if track not in self.tracks:
+                self.tracks[track] = len(self.tracks) + 1
+                self._metadata("thread_name", COORDINATOR_PID, self.tracks[track], track)
+            return COORDINATOR_PID, self.tracks[track]
+        if track not in self.devices:
+            self.devices.add(track)
+            self._metadata("thread_name", DEVICES_PID, track, f"device {track}")
+        return DEVICES_PID, track
+
+    def _timestamp(self, seconds: float) -> float:
+        """Microseconds since the tracer was created"""
+        return (seconds - self.origin) * 1e6
+
+    def complete(
+        self, name: str, track, start: float, end: Optional[float] = None, **args
+    ) -> None:
+        """Record a span between two `now()` times, ending now by default"""
+        end = self.now() if end is None else end
+        pid, tid = self._track(track)
+        self.events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": self._timestamp(start),
+                "dur": max(0.0, end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+    def instant(self, name: str, track, **args) -> None:
+        pid, tid = self._track(track)
+        self.events.append(
+            {
+                "name": name,
+                "ph": "i",
+                "s": "t",
+                "ts": self._timestamp(self.now()),
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+    @contextmanager
+    def span(self, name: str, track=TRAINER_TRACK, **args) -> Iterator[None]:
+        """Record the block as a span"""
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.complete(name, track, start, **args)
+
+    def task_sent(
+        self, task_id: int, device_id: int, request_type: str, start: float, **args
+    ) -> None:
+        """Record the insert of a task's request, which started at `start`"""
+        self.complete("send", device_id, start, task=task_id, **args)
+        self.task_spans[task_id] = (self.now(), "queued", request_type)
+        self.device_tasks[device_id] = task_id
+
+    def device_accepted(self, device_id: int) -> None:
+        """Close the queued span of the task a device has picked up, if any"""
+        task_id = self.device_tasks.pop(device_id, None)
+        span = self.task_spans.get(task_id)
+        if span is None or span[1] != "queued":
+            return
+        start, _, request_type = span
+        self.complete("queued", device_id, start, task=task_id)
+        self.task_spans[task_id] = (self.now(), request_type, request_type)
+
+    def _close_task(self, task_id: int, device_id: int, answered: bool) -> bool:
+        span = self.task_spans.pop(task_id, None)
+        if span is None:
+            return False
+        if self.device_tasks.get(device_id) == task_id:
+            del self.device_tasks[device_id]
+        start, name, request_type = span
+        if answered and name == "queued":
+            # The device answered without being seen busy
+            self.complete(request_type, device_id, start, task=task_id, accepted=False)
+        else:
+            self.complete(name, device_id, start, task=task_id)
+        return True
+
+    def task_answered(self, task_id: int, device_id: int) -> None:
+        """Close the open span of a task whose response was received"""
+        self._close_task(task_id, device_id, answered=True)
+
+    def task_ended(self, task_id: int, device_id: int, reason: str) -> None:
+        """Close the open span of a task that will not answer"""
+        if self._close_task(task_id, device_id, answered=False):
+            self.instant(reason, device_id, task=task_id)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    def write(self, path: Optional[str] = None) -> Optional[str]:
+        """Write the trace as Chrome trace JSON, return the path written if any"""
+        path = path or self.path
+        if path is None:
+            return None
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+        return path
@@ -1,14 +1,21 @@
 import asyncio
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from contextlib import contextmanager, nullcontext
+from dataclasses import replace
+from typing import Dict, List, Optional, Set, Tuple
 
 import numpy as np
 import tf_keras as keras
 
-from .data import split_datasets
-from .federated import average_epoch_loss, average_model_weights
-from .keras_h5_conversion import get_keras_model_graph
-from .worker import RequestConfig, Worker
+from .asynchronous import AsyncAggregator, AsyncPolicy
+from .codec import BINARY_CODEC, JSON_CODEC, get_codec
+from .data import partition_hash, partition_sizes, split_datasets
+from .federated import average_epoch_loss
+from .keras_h5_conversion import get_keras_model_graph, normalize_weight_name
+from .strategies import FedAvg, get_strategy
+from .telemetry import Telemetry
+from .tracing import Tracer
+from .worker import RequestConfig, RoundPolicy, Task, Worker
 
 
 class Trainer:
@@ -21,41 +28,122 @@ class Trainer:
         batch_size: int,
         validation_inputs: Optional[np.ndarray] = None,
         validation_outputs: Optional[np.ndarray] = None,
+        codec: Optional[str] = None,
+        quantization_dtype_map: Optional[Dict] = None,
+        upload_top_k: Optional[float] = None,
+        cache_topology: bool = False,
+        share_weights: bool = False,
+        sticky_partitions: bool = False,
+        incremental_aggregation: bool = True,
+        strategy=None,
+        round_policy: Optional[RoundPolicy] = None,
+        artifact_store=None,
+        backend=None,
+        async_policy: Optional[AsyncPolicy] = None,
+        telemetry: Optional[Telemetry] = None,
+        tracer: Optional[Tracer] = None,
     ):
 
         self.model = model
         self.modelJson = get_keras_model_graph(self.model)
         self.device_urls = None
         self.batch_size = batch_size
+        if codec is None:
+            codec = BINARY_CODEC if quantization_dtype_map else JSON_CODEC
+        self.codec = get_codec(
+            codec,
+            weight_names=[normalize_weight_name(w.name) for w in self.model.weights],
+            quantization_dtype_map=quantization_dtype_map,
+        )
         worker_id = np.random.randint(0, 100000)
-        self.worker = Worker(_id=worker_id)
+        self.worker = Worker(
+            _id=worker_id,
+            codec=self.codec,
+            artifact_store=artifact_store,
+            backend=backend,
+        )
+        self.cache_topology = cache_topology
+        self.model_ref = None
+        self.share_weights = share_weights
+        self.weights_ref = None
+        self.sticky_partitions = sticky_partitions
+        # Device holding each partition of a dataset, by dataset
+        self.partition_devices: Dict[int, List[int]] = {}
         self.inputs = np.asarray(inputs)
         self.outputs = np.asarray(outputs)
         self.validation_inputs = validation_inputs
         self.validation_outputs = validation_outputs
         self.history = defaultdict(list)
         self.device_epochs = 1
-
-    def _create_base_request_config(self, epochs=None) -> RequestConfig:
+        if upload_top_k is not None and not 0 < upload_top_k <= 1:
+            raise ValueError("upload_top_k must be in (0, 1], got %s" % upload_top_k)
+        self.upload_top_k = upload_top_k
+        self.incremental_aggregation = incremental_aggregation
+        self.strategy = get_strategy(strategy)
+        self.round_policy = round_policy if round_policy is not None else RoundPolicy()
+        if async_policy is not None and share_weights:
+            # Every task is sent its own version of the global weights
+            raise ValueError("share_weights is not supported in asynchronous training")
+        if async_policy is not None and type(self.strategy) is not FedAvg:
+            # Updates are merged by the asynchronous aggregator instead
+            raise ValueError(
+                "Strategy %r is not supported in asynchronous training"
+                % type(self.strategy).__name__
+            )
+        self.async_policy = async_policy
+        self.aggregator: Optional[AsyncAggregator] = None
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.tracer = tracer
+        self.worker.tracer = tracer
+        self._begin_round()
+
+    async def _create_base_request_config(
+        self, epochs=None, request_type: str = "train"
+    ) -> RequestConfig:
         """Create base request configuration"""
+        model_json, model_ref = self.modelJson, None
+        if self.cache_topology:
+            if self.model_ref is None:
+                self.model_ref = await self.worker.publish_artifact(self.modelJson)
+            model_json, model_ref = None, self.model_ref
+
+        weights, weights_ref = self._get_weights(), None
+        if self.share_weights:
+            weights, weights_ref = None, await self._publish_weights(weights)
+
         return RequestConfig(
-            modelJson=self.modelJson,
-            weights=self._get_weights(),
+            modelJson=model_json,
+            modelRef=model_ref,
+            weights=weights,
+            weightsRef=weights_ref,
             batchSize=self.batch_size,
             epochs=self.device_epochs,
+            # Only training updates are uploaded as top-k deltas
+            topKFraction=self.upload_top_k if request_type == "train" else None,
+            **self.strategy.request_options(),
         )
 
     def _reset(self):
         """Reset training job data"""
         self.history = defaultdict(list)
 
-    def _get_weights(self) -> List:
-        """Convert numpy arrays to nested lists for JSON serialization"""
-        return [w.tolist() for w in self.model.get_weights()]
+    def _get_weights(self) -> List[np.ndarray]:
+        """Get model weights, the worker's codec serializes them on dispatch"""
+        return self.model.get_weights()
+
+    async def _publish_weights(self, weights: List[np.ndarray]) -> str:
+        """Publish the global weights once for the round, replacing the last round's"""
+        weights_ref = await self.worker.publish_artifact(
+            self.codec.encode_weights(weights)
+        )
+        if self.weights_ref is not None and self.weights_ref != weights_ref:
+            await self.worker.retire_artifact(self.weights_ref)
+        self.weights_ref = weights_ref
+        return weights_ref
 
     def _deserialize_weights(self, weights_data: List) -> List[np.ndarray]:
-        """Convert nested lists back to numpy arrays"""
-        return [np.array(w, dtype=np.float32) for w in weights_data]
+        """Convert decoded response weights to float32 numpy arrays"""
+        return [np.asarray(w, dtype=np.float32) for w in weights_data]
 
     def _to_validate(self):
         """Check if validation data is available"""
@@ -70,64 +158,215 @@ class Trainer:
         request_type: str,
     ) -> None:
         """Dispatch tasks to all available devices"""
+        self._begin_round(request_type)
+        metrics = self.telemetry.current or self.telemetry.begin_round(request_type)
         request_configs = []
+        device_ids = []
 
         for device, device_inputs, device_outputs in datasets:
 
-            request_config.inputs = device_inputs.tolist()
-            request_config.outputs = (
-                device_outputs.tolist() if device_outputs is not None else None
+            device_config = replace(
+                request_config,
+                inputs=device_inputs,
+                outputs=device_outputs,
+                inputShape=list(device_inputs.shape),
+                datasetsPerDevice=len(device_inputs),
             )
-            request_config.inputShape = list(device_inputs.shape)
 
             if device_outputs is not None:
-                request_config.outputShape = list(device_outputs.shape)
-
-            request_config.datasetsPerDevice = len(device_inputs)
-
-            request_configs.append(request_config)
-
-        await self.worker.run(
-            request_type=request_type, request_configs=request_configs
-        )
+                device_config.outputShape = list(device_outputs.shape)
+
+            if self.sticky_partitions:
+                # The worker omits the data of partitions a device already holds
+                device_config.datasetRef = partition_hash(device_inputs, device_outputs)
+
+            request_configs.append(device_config)
+            device_ids.append(device)
+
+        if None in device_ids:
+            # Partitions without a device are queued, idle devices pull them
+            device_ids = None
+
+        # Predictions need every partition, other rounds close at the quorum
+        quorum = None
+        if request_type != "predict":
+            quorum = self.round_policy.quorum_count(len(request_configs))
+
+        with self._span("dispatch", tasks=len(request_configs)):
+            if request_type == "train" and self.async_policy is not None:
+                # Asynchronous runs go on until every queued partition has
+                # trained, or until no device has answered for the idle timeout
+                finished = await self.worker.run(
+                    request_type=request_type,
+                    request_configs=request_configs,
+                    on_response=self._merge_async,
+                    round_policy=replace(self.round_policy, deadline=None),
+                    prepare_request=self._attach_global_model,
+                    task_timeout=self.async_policy.task_timeout,
+                    metrics=metrics,
+                    idle_timeout=self.async_policy.idle_timeout,
+                )
+                if finished.timed_out:
+                    print(
+                        f"No device answered for {self.async_policy.idle_timeout}s, "
+                        "stopping asynchronous training"
+                    )
+                return
+
+            finished = await self.worker.run(
+                request_type=request_type,
+                request_configs=request_configs,
+                device_ids=device_ids,
+                on_response=self._merge_response if self.incremental_aggregation else None,
+                quorum=quorum,
+                round_policy=self.round_policy,
+                metrics=metrics,
+            )
+            self.round_tasks = finished.tasks
+
+    def _begin_round(self, request_type: str = "train") -> None:
+        """Reset the running aggregate before a round is dispatched"""
+        self.round_type = request_type
+        self.accumulator = self.strategy.begin_round(self.model.get_weights())
+        self.round_losses = []
+        self.round_outputs: Dict[int, List] = {}
+        self.round_tasks: Set[int] = set()
+        self.merged_tasks = set()
+
+    def _span(self, name: str, **args):
+        """Trace a block as a phase of the job, if it is traced"""
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(name, **args)
+
+    @contextmanager
+    def _stage(self, name: str):
+        """Time a block as a stage of the current round, if one is recorded"""
+        metrics = self.telemetry.current
+        with metrics.stage(name) if metrics is not None else nullcontext():
+            with self._span(name):
+                yield
+
+    def _merge_response(self, task_id: int, task: Task) -> None:
+        """Fold one device's response into the round aggregate and drop its weights"""
+        if task_id in self.merged_tasks:
+            return
+        response = task.response_data
+        if response.outputs is not None:
+            # Responses arrive in any order, outputs are returned by partition
+            partition = task_id if task.partition is None else task.partition
+            self.round_outputs[partition] = response.outputs
+        num_device_samples = task.request_data.datasetsPerDevice or 1
+        # Devices send weights back for every request, only training updates them
+        training = self.round_type == "train"
+        if training and response.weights is not None:
+            with self._stage("deserialize"):
+                deserialized_weights = self._deserialize_weights(response.weights)
+            with self._stage("aggregate"):
+                self.accumulator.add(deserialized_weights, num_device_samples)
+        if training and response.deltas is not None:
+            with self._stage("aggregate"):
+                self.accumulator.add_sparse(response.deltas, num_device_samples)
+        if response.loss is not None:
+            self.round_losses.append((response.loss, num_device_samples))
+        response.weights = None
+        response.deltas = None
+        self.merged_tasks.add(task_id)
 
     def _gather(
         self, request_type: str
     ) -> Tuple[List[np.ndarray], List[Tuple[float, int]]]:
         """Gather results from all devices, update model weights, and compute loss"""
-        all_weights = []
-        epoch_device_losses = []
-        outputs = []
-
         results = self.worker.task_manager.completed_tasks.items()
 
-        for task_id, task in list(results):
-            if task.response_data.outputs is not None:
-                outputs.append(task.response_data.outputs)
-            if task.response_data.weights is not None:
-                deserialized_weights = self._deserialize_weights(
-                    task.response_data.weights
-                )
-                all_weights.append(deserialized_weights)
-            if task.response_data.loss is not None:
-                loss = task.response_data.loss
-                num_samples = len(results)
-                epoch_device_losses.append((loss, num_samples))
-            del self.worker.task_manager.tasks[task_id]
-
-        if all_weights:
-            averaged_weights = average_model_weights(all_weights)
-            self.model.set_weights(averaged_weights)
-
-        if epoch_device_losses:
-            average_loss = average_epoch_loss(epoch_device_losses)
+        with self._span("gather"):
+            for task_id, task in list(results):
+                if task_id in self.round_tasks:
+                    self._merge_response(task_id, task)
+                self.worker.task_manager.discard_task(task_id)
+
+        if request_type == "train" and self.accumulator.num_updates:
+            with self._stage("aggregate"):
+                weights = self.strategy.aggregate(self.accumulator)
+            with self._stage("set_weights"):
+                self.model.set_weights(weights)
+
+        if self.round_losses:
+            average_loss = average_epoch_loss(self.round_losses)
             self.history[f"{request_type}_loss"].append(average_loss)
 
-        return outputs
+        self.telemetry.end_round()
+        return [outputs for _, outputs in sorted(self.round_outputs.items())]
+
+    def _split(
+        self,
+        inputs: np.ndarray,
+        devices: List[int],
+        outputs: Optional[np.ndarray] = None,
+        request_type: str = "train",
+    ) -> List[Tuple[Optional[int], np.ndarray, Optional[np.ndarray]]]:
+        """Split data across devices, or into queued partitions when the policy asks for more"""
+        policy = self.round_policy
+        with self._stage("split"):
+            if policy.partitions_per_device > 1:
+                devices = [None] * (len(devices) * policy.partitions_per_device)
+                return split_datasets(inputs, devices, outputs, include_outputs=True)
+            if self.sticky_partitions:
+                devices = self._sticky_devices(inputs, devices)
+            sizes = None
+            if policy.capacity_weighted and request_type == "evaluate":
+                # Only evaluation takes longer on a larger share
+                sizes = partition_sizes(
+                    len(inputs),
+                    self.worker.device_profiles.capacities(devices),
+                    min_samples=policy.min_device_samples,
+                    max_samples=policy.max_device_samples,
+                )
+            return split_datasets(
+                inputs, devices, outputs, include_outputs=True, sizes=sizes
+            )
+
+    def _sticky_devices(self, inputs: np.ndarray, devices: List[int]) -> List[int]:
+        """
+        Order devices so that each partition of `inputs` goes to the device
+        that held it last time, if it is still among `devices`. Partitions
+        whose device is gone go to the new devices.
+        """
+        previous = self.partition_devices.get(id(inputs), [])
+        if len(previous) != len(devices):
+            # Partition boundaries move with the number of devices
+            previous = []
+        remaining = set(devices)
+        assignment = []
+        for device in previous:
+            if device in remaining:
+                remaining.discard(device)
+                assignment.append(device)
+            else:
+                assignment.append(None)
+        newcomers = iter([device for device in devices if device in remaining])
+        assignment = [next(newcomers) if device is None else device for device in assignment]
+        assignment += list(newcomers)
+        self.partition_devices[id(inputs)] = assignment
+        return assignment
 
     async def _dispatch_gather(self, request_config, datasets, request_type):
-        await self._dispatch(request_config, datasets, request_type)
-        return self._gather(request_type)
+        with self._span(f"{request_type} round"):
+            await self._dispatch(request_config, datasets, request_type)
+            return self._gather(request_type)
+
+    async def _in_session(self, job, name: str):
+        """
+        Run a job within one realtime session, shared by all of its rounds, and
+        write its trace if it is traced
+        """
+        try:
+            with self._span(name):
+                async with self.worker.session():
+                    return await job
+        finally:
+            if self.tracer is not None:
+                self.tracer.write()
 
     def _print_progress(self, epoch, epochs):
         """Print progress of training"""
@@ -141,17 +380,21 @@ class Trainer:
 
     async def _fit(self, epochs):
         """Run federated training process"""
-        available_devices = self.worker.load_available_devices()
+        if self.async_policy is not None:
+            return await self._fit_async(epochs)
+
+        available_devices = await self.worker.load_available_devices()
         print(f"Training on {len(available_devices)} devices")
 
         async def fit_epoch(epoch):
-            request_config = self._create_base_request_config(epochs)
+            request_config = await self._create_base_request_config(epochs)
+            available_devices = await self.worker.load_available_devices()
 
-            datasets = split_datasets(
+            self.telemetry.begin_round("train")
+            datasets = self._split(
                 self.inputs,
-                available_devices,
+                self.round_policy.select_devices(available_devices),
                 self.outputs,
-                include_outputs=True,
             )
 
             await self._dispatch_gather(request_config, datasets, "train")
@@ -162,35 +405,112 @@ class Trainer:
             self._print_progress(epoch, epochs)
 
         for epoch in range(epochs):
-            await fit_epoch(epoch)
+            with self._span(f"epoch {epoch + 1}"):
+                await fit_epoch(epoch)
+
+    async def _fit_async(self, epochs):
+        """Run asynchronous training, merging every update as it arrives"""
+        available_devices = await self.worker.load_available_devices()
+        print(f"Training asynchronously on {len(available_devices)} devices")
+
+        request_config = await self._create_base_request_config(epochs)
+        self.telemetry.begin_round("train")
+        datasets = self._split(
+            self.inputs,
+            [None] * len(self.round_policy.select_devices(available_devices)),
+            self.outputs,
+        )
+        self.aggregator = AsyncAggregator(self.model.get_weights(), self.async_policy)
+        self.async_partitions = len(datasets)
+        self.epoch_losses = defaultdict(list)
+
+        # Every epoch queues each partition once, idle devices pull the next one
+        self._begin_round()
+        with self._span("train round"):
+            await self._dispatch(request_config, datasets * epochs, "train")
+            with self._stage("aggregate"):
+                self.aggregator.merge()
+            with self._stage("set_weights"):
+                self.model.set_weights(self.aggregator.weights)
+
+        for epoch in range(epochs):
+            if self.epoch_losses[epoch]:
+                average_loss = average_epoch_loss(self.epoch_losses[epoch])
+                self.history["train_loss"].append(average_loss)
+        for task_id in list(self.worker.task_manager.completed_tasks):
+            self.worker.task_manager.discard_task(task_id)
+        self.telemetry.end_round()
+
+        if self._to_validate():
+            await self._evaluate()
+        self._print_progress(epochs - 1, epochs)
+
+    def _attach_global_model(self, partition: int, config: RequestConfig) -> RequestConfig:
+        """Send a task the latest global weights, tagged with their version"""
+        return replace(
+            config,
+            weights=self.aggregator.weights,
+            modelVersion=self.aggregator.version,
+        )
+
+    def _merge_async(self, task_id: int, task: Task) -> None:
+        """Merge one device's update into the global model as soon as it arrives"""
+        response = task.response_data
+        num_device_samples = task.request_data.datasetsPerDevice or 1
+        weights = None
+        if response.weights is not None:
+            with self._stage("deserialize"):
+                weights = self._deserialize_weights(response.weights)
+        with self._stage("aggregate"):
+            merged = self.aggregator.add(
+                task.request_data.modelVersion,
+                num_device_samples,
+                weights=weights,
+                deltas=response.deltas,
+            )
+        if response.loss is not None:
+            epoch = task.partition // self.async_partitions
+            self.epoch_losses[epoch].append((response.loss, num_device_samples))
+        response.weights = None
+        response.deltas = None
+
+        if merged:
+            self.aggregator.release(
+                request.modelVersion for request in self.worker.live_requests()
+            )
 
     def fit(self, epochs: int) -> None:
         """Run federated training process"""
-        asyncio.run(self._fit(epochs))
+        asyncio.run(self._in_session(self._fit(epochs), "fit"))
 
     async def _evaluate(self) -> None:
         """Run distributed evaluation across all devices"""
-        request_config = self._create_base_request_config()
+        request_config = await self._create_base_request_config(request_type="evaluate")
+        available_devices = await self.worker.load_available_devices()
 
-        datasets = split_datasets(
+        self.telemetry.begin_round("evaluate")
+        datasets = self._split(
             self.validation_inputs,
-            self.worker.load_available_devices(),
+            self.round_policy.select_devices(available_devices),
             self.validation_outputs,
-            include_outputs=True,
+            request_type="evaluate",
         )
 
         await self._dispatch_gather(request_config, datasets, "evaluate")
 
     def evaluate(self) -> None:
         """Run distributed evaluation across all devices"""
-        asyncio.run(self._evaluate())
+        asyncio.run(self._in_session(self._evaluate(), "evaluate"))
 
     async def _predict(self, inputs: np.ndarray) -> Tuple[np.ndarray, Optional[float]]:
         """Run distributed prediction across all devices"""
-        request_config = self._create_base_request_config()
-        datasets = split_datasets(inputs, self.worker.load_available_devices())
+        request_config = await self._create_base_request_config(request_type="predict")
+        available_devices = await self.worker.load_available_devices()
+        self.telemetry.begin_round("predict")
+        with self._stage("split"):
+            datasets = split_datasets(inputs, available_devices)
         return await self._dispatch_gather(request_config, datasets, "predict")
     
     def predict(self, inputs: np.ndarray) -> Tuple[np.ndarray, Optional[float]]:
         """Run distributed prediction across all devices"""
-        return asyncio.run(self._predict(inputs))
+        return asyncio.run(self._in_session(self._predict(inputs), "predict"))
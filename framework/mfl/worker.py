@@ -1,19 +1,28 @@
 import asyncio
-import os
-from dataclasses import asdict, dataclass
+import heapq
+import math
+import random
+import statistics
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
 
 from dateutil.parser import parse
-from dotenv import load_dotenv
-from realtime._async.client import AsyncRealtimeClient
-from supabase import Client, create_client
 
-load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
+from .artifacts import content_hash
+from .backend import SupabaseBackend
+from .codec import JsonCodec
+from .compression import SparseDelta
+from .devices import DeviceRegistry
+from .profiles import DeviceProfiles
+from .telemetry import RoundMetrics
+from .tracing import WORKER_TRACK, Tracer
+
 TASK_TIMEOUT = 10  # seconds
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+INSERT_CHUNK_SIZE = 100  # task requests inserted per call
 
 
 @dataclass
@@ -27,24 +36,121 @@ class RequestConfig:
     outputShape: Optional[List[int]] = None
     epochs: Optional[int] = None
     datasetsPerDevice: Optional[int] = None
+    topKFraction: Optional[float] = None
+    modelRef: Optional[str] = None
+    weightsRef: Optional[str] = None
+    datasetRef: Optional[str] = None
+    proximalMu: Optional[float] = None
+    modelVersion: Optional[int] = None
 
 
 @dataclass
 class ResponseConfig:
-    weights: List[List[float]]
+    weights: Optional[List[List[float]]] = None
     outputs: Optional[List[List[float]]] = None
     loss: Optional[float] = None
+    deltas: Optional[List[SparseDelta]] = None
 
 
 @dataclass
+class RoundPolicy:
+    """
+    When a round of tasks is dispatched and closed.
+
+    - devices_per_round: number of updates a round needs (N). None uses every
+      available device.
+    - over_provision: extra devices (k) a round is dispatched to on top of N.
+    - quorum: responses after which the round closes, as a count (int) or as a
+      fraction of the dispatched tasks (float). None means N when
+      devices_per_round is set, otherwise every dispatched task.
+    - deadline: seconds after the first task is sent at which the round closes
+      with whatever has completed. None waits for the quorum.
+    - backup_tasks: re-dispatch the partition of a straggling task to an idle
+      device, and keep whichever copy finishes first.
+    - straggler_factor: a task straggles once it has been pending for this
+      multiple of the median latency of the round's completed tasks.
+    - straggler_min_responses: fraction of the round's partitions that must
+      have completed before that median is trusted.
+    - partitions_per_device: when above 1, the data is split into this many
+      partitions per selected device and queued. Every available device pulls
+      its next partition as soon as it completes one, so faster devices do
+      more of the work and devices that become available join mid-round.
+    - capacity_weighted: size each device's share of the evaluation data by
+      its throughput measured in evaluation rounds (see `DeviceProfiles`), so
+      that all devices are expected to finish together. Shares are kept
+      within [min_device_samples, max_device_samples]. Training shares stay
+      even, since devices train `batchSize` steps whatever their share. Only
+      applies when data is pinned to devices.
+
+    Tasks still pending when a round closes are cancelled.
+    """
+
+    devices_per_round: Optional[int] = None
+    over_provision: int = 0
+    quorum: Optional[Union[int, float]] = None
+    deadline: Optional[float] = TASK_TIMEOUT
+    backup_tasks: bool = False
+    straggler_factor: float = 2.0
+    straggler_min_responses: float = 0.5
+    partitions_per_device: int = 1
+    capacity_weighted: bool = False
+    min_device_samples: int = 1
+    max_device_samples: Optional[int] = None
+
+    def select_devices(self, available_devices: List[int]) -> List[int]:
+        if self.devices_per_round is None:
+            return list(available_devices)
+        count = min(
+            len(available_devices), self.devices_per_round + self.over_provision
+        )
+        return random.sample(list(available_devices), count)
+
+    def quorum_count(self, num_dispatched: int) -> int:
+        if self.quorum is None and self.devices_per_round is not None:
+            quorum = self.devices_per_round * self.partitions_per_device
+        elif self.quorum is None:
+            quorum = num_dispatched
+        elif isinstance(self.quorum, float):
+            quorum = math.ceil(self.quorum * num_dispatched)
+        else:
+            quorum = self.quorum
+        return max(1, min(quorum, num_dispatched))
+
+
 class Task:
     """
     A class to manage tasks broadcasted to the mfl network.
+
+    Tasks are kept by the tens of thousands, so they use slots instead of a
+    per-instance dict. `partition` is the index of its request config in the
+    run that sent it.
     """
 
-    request_data: RequestConfig
-    sent_at: datetime
-    response_data: Optional[ResponseConfig] = None
+    __slots__ = (
+        "request_data",
+        "sent_at",
+        "response_data",
+        "device_id",
+        "partition",
+    )
+
+    def __init__(
+        self,
+        request_data: RequestConfig,
+        sent_at: datetime,
+        response_data: Optional[ResponseConfig] = None,
+        device_id: Optional[int] = None,
+        partition: Optional[int] = None,
+    ):
+        self.request_data = request_data
+        self.sent_at = sent_at
+        self.response_data = response_data
+        self.device_id = device_id
+        self.partition = partition
+
+    def __repr__(self) -> str:
+        status = "complete" if self.is_completed else "incomplete"
+        return f"Task(device_id={self.device_id}, sent_at={self.sent_at}, {status})"
 
     @property
     def is_completed(self) -> bool:
@@ -53,17 +159,24 @@ class Task:
     @property
     def is_expired(self) -> bool:
         return (not self.is_completed) and (
-            (datetime.now(timezone.utc) - self.sent_at).total_seconds() > TASK_TIMEOUT
-        )
+            datetime.now(timezone.utc) - self.sent_at
+        ).total_seconds() > TASK_TIMEOUT
 
 
 class TaskManager:
     """
-    A class to manage each consumer's collection of tasks
+    A class to manage each consumer's collection of tasks.
+
+    Pending and completed task ids are kept as sets that are updated on every
+    transition, so that listing tasks by state only touches the tasks in that
+    state. Tasks of a run expire through the per-task timeout of its round;
+    `expired_tasks` only reports the pending tasks older than `TASK_TIMEOUT`.
     """
 
     def __init__(self):
         self.tasks: Dict[int, Task] = {}
+        self.pending: Set[int] = set()
+        self.completed: Set[int] = set()
 
     def __repr__(self) -> str:
         task_list = []
@@ -72,40 +185,165 @@ class TaskManager:
             task_list.append(f"Task {task_id}: {status}")
         return "\n".join(task_list)
 
+    def __len__(self) -> int:
+        return len(self.tasks)
+
     def create_task(
-        self, task_id: int, request_data: RequestConfig, sent_at: datetime
+        self,
+        task_id: int,
+        request_data: RequestConfig,
+        sent_at: datetime,
+        device_id: Optional[int] = None,
+        partition: Optional[int] = None,
     ) -> None:
         if task_id in self.tasks:
             raise ValueError(f"Task {task_id} already exists.")
-        self.tasks[task_id] = Task(request_data=request_data, sent_at=sent_at)
+        task = Task(
+            request_data=request_data,
+            sent_at=sent_at,
+            device_id=device_id,
+            partition=partition,
+        )
+        self.tasks[task_id] = task
+        self.pending.add(task_id)
 
     def discard_task(self, task_id: int) -> None:
         del self.tasks[task_id]
+        self.pending.discard(task_id)
+        self.completed.discard(task_id)
 
     def log_completion(self, task_id: int, response_data: ResponseConfig) -> None:
         if task_id not in self.tasks:
             raise KeyError(f"Task {task_id} does not exist.")
         self.tasks[task_id].response_data = response_data
+        self.pending.discard(task_id)
+        self.completed.add(task_id)
 
     @property
     def expired_tasks(self):
         return {
-            task_id: task for task_id, task in self.tasks.items() if task.is_expired
+            task_id: self.tasks[task_id]
+            for task_id in self.pending
+            if self.tasks[task_id].is_expired
         }
 
     @property
     def completed_tasks(self):
-        return {
-            task_id: task for task_id, task in self.tasks.items() if task.is_completed
-        }
+        return {task_id: self.tasks[task_id] for task_id in self.completed}
 
     @property
     def incomplete_tasks(self):
-        return {
-            task_id: task
-            for task_id, task in self.tasks.items()
-            if not task.is_completed
-        }
+        return {task_id: self.tasks[task_id] for task_id in self.pending}
+
+
+class Round:
+    """
+    State of one run of the worker: its partitions, the tasks sent for them,
+    the devices they keep busy and the timers that close the run.
+
+    `Worker.run` creates a round, makes it the worker's current round for as
+    long as the run lasts and returns it once it is over, so that nothing of
+    a run leaks into the next one. Partitions are the indices of the request
+    configs of the round.
+    """
+
+    def __init__(
+        self,
+        request_type: str,
+        request_configs: List[RequestConfig],
+        policy: Optional[RoundPolicy] = None,
+        quorum: Optional[int] = None,
+        on_response: Optional[Callable[[int, Task], None]] = None,
+        prepare_request: Optional[Callable[[int, RequestConfig], RequestConfig]] = None,
+        task_timeout: Optional[float] = None,
+        metrics: Optional[RoundMetrics] = None,
+        idle_timeout: Optional[float] = None,
+    ):
+        self.request_type = request_type
+        self.policy = policy if policy is not None else RoundPolicy()
+        self.quorum = quorum
+        self.on_response = on_response
+        self.prepare_request = prepare_request
+        self.task_timeout = task_timeout
+        self.metrics = metrics
+        self.idle_timeout = idle_timeout
+        self.done = asyncio.Event()
+        self.timed_out = False
+        # Loop time at which the round started, and at which a task last completed
+        self.started = asyncio.get_running_loop().time()
+        self.last_response = self.started
+        self.partition_configs = list(request_configs)
+        # Tasks sent in the round, and those still waiting for their response
+        self.tasks: Set[int] = set()
+        self.pending_tasks: Set[int] = set()
+        self.task_partitions: Dict[int, int] = {}
+        self.partition_tasks: Dict[int, Set[int]] = defaultdict(set)
+        self.partition_queue: Deque[int] = deque()
+        self.pending_partitions: Set[int] = set()
+        self.completed_partitions: Set[int] = set()
+        self.backup_partitions: Set[int] = set()
+        self.busy_devices: Set[int] = set()
+        # Loop time at which each pending task was sent, and the latencies of
+        # the completed ones
+        self.task_started: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        # Per-task timeout, as (loop time, task id) expiries
+        self.task_expiries: List[Tuple[float, int]] = []
+        self.deadline_timer: Optional[asyncio.TimerHandle] = None
+        self.backup_timer: Optional[asyncio.TimerHandle] = None
+        self.expiry_timer: Optional[asyncio.TimerHandle] = None
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+
+    def quorum_reached(self) -> bool:
+        """
+        Whether enough partitions have completed to close the round
+        """
+        if not self.pending_partitions and not self.partition_queue:
+            return True
+        if self.quorum is None:
+            return False
+        return len(self.completed_partitions) >= self.quorum
+
+    def straggler_threshold(self) -> Optional[float]:
+        """
+        Seconds after which a pending task straggles, or None while too few
+        partitions have completed to tell
+        """
+        min_responses = max(
+            1,
+            math.ceil(self.policy.straggler_min_responses * len(self.partition_configs)),
+        )
+        if len(self.latencies) < min_responses:
+            return None
+        return self.policy.straggler_factor * statistics.median(self.latencies)
+
+    def partition_request(self, partition: int) -> RequestConfig:
+        """
+        Request config to send for a partition
+        """
+        request_data = self.partition_configs[partition]
+        if self.prepare_request is not None:
+            request_data = self.prepare_request(partition, request_data)
+        return request_data
+
+    def close(self) -> None:
+        """
+        Stop the timers of the round and mark it as done
+        """
+        for timer in (
+            self.deadline_timer,
+            self.backup_timer,
+            self.expiry_timer,
+            self.idle_timer,
+        ):
+            if timer is not None:
+                timer.cancel()
+        self.deadline_timer = None
+        self.backup_timer = None
+        self.expiry_timer = None
+        self.idle_timer = None
+        self.partition_queue.clear()
+        self.done.set()
 
 
 class Worker:
@@ -113,149 +351,814 @@ class Worker:
     A class to manage the worker's interactions with the mfl network
     """
 
-    def __init__(self, _id: int) -> None:
+    def __init__(
+        self, _id: int, codec=None, artifact_store=None, backend=None
+    ) -> None:
         self.id = _id
+        self.codec = codec if codec is not None else JsonCodec()
+        self.backend = backend if backend is not None else SupabaseBackend()
+        self.artifact_store = (
+            artifact_store
+            if artifact_store is not None
+            else self.backend.artifact_store()
+        )
+        self.published_artifacts = set()
+        self.insert_chunk_size = INSERT_CHUNK_SIZE
         self.task_manager = TaskManager()
-        self.timeout = False
+        # Devices that go offline lose the partitions they held
+        self.devices = DeviceRegistry(on_drop=self._forget_partitions)
+        self.connected = False
+        # State of the run in progress, if any
+        self.round: Optional[Round] = None
+        # Backend calls started from callbacks, awaited before a run returns
+        self.background_calls: Set[asyncio.Task] = set()
+        # Batches of requests reserved until their insert returns, by id, and
+        # the responses that arrived before the insert of their request returned
+        self.sends_in_flight: Dict[int, List[Tuple[int, RequestConfig, Optional[int]]]] = {}
+        self.early_responses: Dict[int, Dict] = {}
+        self.tracer: Optional[Tracer] = None
+        self.device_profiles = DeviceProfiles()
+        # Dataset references each device is known to hold
+        self.device_partitions: Dict[int, Set[str]] = defaultdict(set)
 
-    def send_task(
-        self, device_id: int, request_type: str, request_data: RequestConfig
+    async def publish_artifact(self, payload) -> str:
+        """
+        Publish a payload shared by many tasks and return its content hash.
+        Each distinct payload is only written to the artifact store once.
+        """
+        key = content_hash(payload)
+        if key not in self.published_artifacts:
+            await self.backend.offload(self.artifact_store.put, key, payload)
+            self.published_artifacts.add(key)
+        return key
+
+    async def retire_artifact(self, key: str) -> None:
+        """
+        Remove an artifact that no task will reference anymore
+        """
+        if key in self.published_artifacts:
+            await self.backend.offload(self.artifact_store.delete, key)
+            self.published_artifacts.discard(key)
+
+    async def send_task(
+        self,
+        device_id: int,
+        request_type: str,
+        request_data: RequestConfig,
+        partition: Optional[int] = None,
     ) -> bool:
         """
-        Main method that sends a request to a given device
+        Main method that sends a request to a given device. `partition` is the
+        index of the request config in the current round.
         """
+        task_ids = await self.send_tasks(
+            request_type, [(device_id, request_data, partition)]
+        )
+        return task_ids[0] is not None
+
+    async def send_tasks(
+        self,
+        request_type: str,
+        assignments: List[Tuple[int, RequestConfig, Optional[int]]],
+        requeue: bool = False,
+    ) -> List[Optional[int]]:
+        """
+        Send many requests at once, as (device id, request config, partition)
+        assignments. Rows are inserted `insert_chunk_size` at a time and all
+        returned ids are registered together. A rejected chunk is retried row
+        by row, so that every failing request is reported on its own. With
+        `requeue`, the partitions of failed requests are queued again.
+
+        Tasks sent while a run is in progress belong to its round.
+
+        Returns the id of each task, None for the requests that were not sent.
+        """
+        current = self.round
+        self._reserve(current, assignments)
+        task_ids: List[Optional[int]] = [None] * len(assignments)
+        metrics = current.metrics if current is not None else None
+        tracer = self.tracer
         try:
-            response = (
-                supabase.table("task_requests")
-                .insert(
-                    {
-                        "device_id": device_id,
-                        "request_type": request_type,
-                        "data": asdict(request_data),
-                        "consumer_id": self.id,
-                    }
+            rows = []
+            serialize_started = time.perf_counter()
+            for index, (device_id, request_data, _) in enumerate(assignments):
+                try:
+                    rows.append(
+                        (index, self._task_row(device_id, request_type, request_data))
+                    )
+                except Exception as e:
+                    print(f"Error encoding job request for device {device_id}: {e}")
+            if metrics is not None:
+                metrics.stages["serialize"] += time.perf_counter() - serialize_started
+            if tracer is not None:
+                tracer.complete(
+                    "serialize", WORKER_TRACK, serialize_started, tasks=len(assignments)
                 )
-                .execute()
-            )
 
-            self.task_manager.create_task(
-                task_id=response.data[0]["id"],
-                request_data=request_data,
-                sent_at=parse(response.data[0]["created_at"]),
-            )
-            # print(f"Sent task {response.data[0]['id']}")
-            return True
+            for start in range(0, len(rows), self.insert_chunk_size):
+                chunk = rows[start : start + self.insert_chunk_size]
+                insert_started = time.perf_counter()
+                inserted = await self._insert_rows(chunk)
+                if metrics is not None:
+                    metrics.stages["dispatch"] += time.perf_counter() - insert_started
+                if tracer is not None:
+                    tracer.complete("insert", WORKER_TRACK, insert_started, rows=len(chunk))
+                for index, record in inserted:
+                    device_id, request_data, partition = assignments[index]
+                    task_ids[index] = self._register_task(
+                        current, record, device_id, request_data, partition
+                    )
+                    if metrics is not None:
+                        metrics.dispatched += 1
+                        metrics.sent(device_id, record["data"])
+                    if tracer is not None and task_ids[index] is not None:
+                        tracer.task_sent(
+                            task_ids[index],
+                            device_id,
+                            request_type,
+                            insert_started,
+                            partition=partition,
+                        )
+        finally:
+            del self.sends_in_flight[id(assignments)]
+
+        for (device_id, _, _), task_id in zip(assignments, task_ids):
+            if task_id is None:
+                self._forget_partitions(device_id)
+        if current is None:
+            self._replay_early_responses(task_ids)
+            return task_ids
+        for (device_id, _, partition), task_id in reversed(
+            list(zip(assignments, task_ids))
+        ):
+            if task_id is None:
+                self._release(current, device_id, partition)
+                if requeue and partition is not None:
+                    current.partition_queue.appendleft(partition)
+        if any(task_id is not None for task_id in task_ids):
+            self._arm_deadline(current)
+            self._schedule_expiry(current)
+        self._replay_early_responses(task_ids)
+        self._check_round(current)
+        return task_ids
+
+    def live_requests(self) -> List[RequestConfig]:
+        """
+        Request configs of the current run that may still be answered: those
+        of pending tasks and those whose insert is in flight
+        """
+        live = []
+        if self.round is not None:
+            tasks = self.task_manager.tasks
+            live = [tasks[task_id].request_data for task_id in self.round.pending_tasks]
+        for assignments in self.sends_in_flight.values():
+            live += [request_data for _, request_data, _ in assignments]
+        return live
+
+    def _reserve(
+        self,
+        current: Optional[Round],
+        assignments: List[Tuple[int, RequestConfig, Optional[int]]],
+    ) -> None:
+        """
+        Mark the devices and partitions of requests about to be sent as taken,
+        so that no callback hands them out again while the insert is in flight
+        """
+        self.sends_in_flight[id(assignments)] = assignments
+        if current is None:
+            return
+        for device_id, _, partition in assignments:
+            current.busy_devices.add(device_id)
+            if partition is not None:
+                current.pending_partitions.add(partition)
+
+    def _release(self, current: Round, device_id: int, partition: Optional[int]) -> None:
+        """
+        Undo the reservation of a request that could not be sent
+        """
+        if not any(
+            self.task_manager.tasks[task_id].device_id == device_id
+            for task_id in current.pending_tasks
+        ):
+            current.busy_devices.discard(device_id)
+        if partition is not None and not (
+            current.partition_tasks.get(partition, set()) & current.pending_tasks
+        ):
+            current.pending_partitions.discard(partition)
+
+    def _forget_partitions(self, device_id: int) -> None:
+        """
+        Stop assuming that a device holds its partitions, e.g. once it went
+        offline or did not answer, so that it is sent its data again
+        """
+        self.device_partitions.pop(device_id, None)
+
+    def _task_row(
+        self, device_id: int, request_type: str, request_data: RequestConfig
+    ) -> Dict[str, Any]:
+        """
+        Build the `task_requests` row of a request
+        """
+        payload = vars(request_data)
+        if request_data.datasetRef in self.device_partitions.get(device_id, ()):
+            # The device still holds this partition, only its reference is sent
+            payload = dict(payload, inputs=None, outputs=None)
+        return {
+            "device_id": device_id,
+            "request_type": request_type,
+            "data": self.codec.encode_request(payload),
+            "consumer_id": self.id,
+        }
+
+    async def _insert_rows(
+        self, rows: List[Tuple[int, Dict[str, Any]]]
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Insert indexed rows into `task_requests` with one call, falling back to
+        one call per row if it is rejected. Returns the inserted records with
+        the index of their row.
+        """
+        try:
+            records = await self.backend.insert_task_requests([row for _, row in rows])
+            return [(index, record) for (index, _), record in zip(rows, records)]
         except Exception as e:
-            print(f"Error sending job request: {e}")
-            return False
+            if len(rows) == 1:
+                print(f"Error sending job request to device {rows[0][1]['device_id']}: {e}")
+                return []
+
+        inserted = []
+        for row in rows:
+            inserted += await self._insert_rows([row])
+        return inserted
+
+    def _register_task(
+        self,
+        current: Optional[Round],
+        record: Dict[str, Any],
+        device_id: int,
+        request_data: RequestConfig,
+        partition: Optional[int],
+    ) -> int:
+        """
+        Track an inserted request as a task, pending in the round that sent it
+        """
+        task_id = record["id"]
+        self.task_manager.create_task(
+            task_id=task_id,
+            request_data=request_data,
+            sent_at=parse(record["created_at"]),
+            device_id=device_id,
+            partition=partition,
+        )
+        if current is None:
+            return task_id
+        current.tasks.add(task_id)
+        current.pending_tasks.add(task_id)
+        current.busy_devices.add(device_id)
+        current.task_started[task_id] = asyncio.get_running_loop().time()
+        if current.task_timeout is not None:
+            heapq.heappush(
+                current.task_expiries,
+                (current.task_started[task_id] + current.task_timeout, task_id),
+            )
+        if partition is not None:
+            current.task_partitions[task_id] = partition
+            current.partition_tasks[partition].add(task_id)
+            current.pending_partitions.add(partition)
+        return task_id
+
+    def _replay_early_responses(self, task_ids: List[Optional[int]]) -> None:
+        """
+        Handle the responses that arrived for the given tasks before they were
+        registered, and drop the others once no insert is in flight
+        """
+        for task_id in task_ids:
+            if task_id in self.early_responses:
+                self._handle_response(self.early_responses.pop(task_id))
+        if not self.sends_in_flight:
+            self.early_responses.clear()
 
-    async def _connect_to_realtime(self):
+    def _spawn(self, call) -> None:
         """
-        We subscribe to realtime updates to ALL supabase tables and 
-        pass them to the centralized callback function
+        Start a backend call from a synchronous callback. Calls still running
+        when a run closes are awaited before it returns.
+        """
+        task = asyncio.get_running_loop().create_task(call)
+        self.background_calls.add(task)
+        task.add_done_callback(self.background_calls.discard)
+
+    async def _drain(self) -> None:
+        """
+        Wait for the backend calls started from callbacks
+        """
+        while self.background_calls:
+            await asyncio.gather(*self.background_calls, return_exceptions=True)
+
+    async def connect(self) -> None:
         """
-        client = AsyncRealtimeClient(
-            f"{SUPABASE_URL}/realtime/v1", SUPABASE_ANON_KEY, auto_reconnect=False
+        Load the available devices and open the realtime session, in which
+        updates of the devices and task_responses tables are routed to the
+        active run. Does nothing if the session is already open.
+        """
+        if self.connected:
+            return
+        await self._seed_devices()
+        await self.backend.connect(
+            on_device_update=self._device_update_callback,
+            on_task_response=self._task_update_callback,
+            on_reconnect=self._resync,
         )
-        await client.connect()
-        
-        device_channel = client.channel(f"devices")
-        task_completion_channel = client.channel(f"task_responses")
-        
-        self.available_devices = self.load_available_devices()
-
-        await device_channel.on_postgres_changes(
-            "UPDATE",
-            schema="public",
-            table='devices',
-            callback=self._device_update_callback,
-        ).subscribe()
-        
-        await task_completion_channel.on_postgres_changes(
-            "INSERT",
-            schema="public",
-            table='task_responses',
-            callback=self._task_update_callback,
-        ).subscribe()
-
-        self.listener = asyncio.create_task(client.listen())
+        self.connected = True
+
+    async def close(self) -> None:
+        """
+        Close the realtime session
+        """
+        if self.connected:
+            await self.backend.close()
+            self.connected = False
+            # Updates are missed from now on, the next session seeds again
+            self.devices.seeded = False
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator["Worker"]:
+        """
+        Keep one realtime session open for every run in the block. Nested
+        sessions reuse the outer one.
+        """
+        if self.connected:
+            yield self
+            return
+        await self.connect()
+        try:
+            yield self
+        finally:
+            await self.close()
+
+    async def _resync(self) -> None:
+        """
+        Pick up the responses and device updates missed while the realtime
+        session was down
+        """
+        await self._seed_devices()
+        if self.task_manager.pending:
+            for record in await self.backend.fetch_task_responses(
+                list(self.task_manager.pending)
+            ):
+                self._handle_response(record)
+        self._feed_devices(self.devices.available())
 
     async def run(
-        self, request_configs: List[RequestConfig], request_type: str
-    ) -> None:
-        """Multi-device federated learning process"""
+        self,
+        request_configs: List[RequestConfig],
+        request_type: str,
+        device_ids: Optional[List[int]] = None,
+        on_response: Optional[Callable[[int, Task], None]] = None,
+        quorum: Optional[int] = None,
+        round_policy: Optional[RoundPolicy] = None,
+        prepare_request: Optional[Callable[[int, RequestConfig], RequestConfig]] = None,
+        task_timeout: Optional[float] = None,
+        metrics: Optional[RoundMetrics] = None,
+        idle_timeout: Optional[float] = None,
+    ) -> Round:
+        """
+        Multi-device federated learning process. When `device_ids` is given,
+        each request config is sent to the device at the same position.
+        Otherwise the configs are queued, every available device is sent the
+        next one whenever it is idle, i.e. at the start of the run, when it
+        completes a task or when it becomes available.
+
+        `on_response` is called with the task id and task of every response of
+        this run as soon as it has been decoded.
+
+        The run closes once `quorum` partitions have completed (every partition
+        when None) or at the deadline of `round_policy`, whichever comes first.
+        Tasks still pending at that point are cancelled. When the policy enables
+        backup tasks, straggling partitions are also sent to idle devices and
+        the first copy to complete is kept.
+
+        `prepare_request` is called with the partition and request config of
+        every task right before it is sent, and returns the config to send.
+        Tasks that have not answered within `task_timeout` seconds are
+        cancelled and their partition is queued again. The run also times out
+        once no task has completed for `idle_timeout` seconds.
+
+        When `metrics` is given, the timings, byte counts and latencies of the
+        run are recorded in it.
+
+        Returns the round of the run, once it is over.
+        """
         assert request_type in (
             "train",
             "evaluate",
             "predict",
         ), "Unsupported request type!"
-        self.request_type = request_type
-        self.request_configs = request_configs
 
-        await self._connect_to_realtime()
+        # Runs outside of a session open and close their own
+        owns_session = not self.connected
+        await self.connect()
+        current = Round(
+            request_type,
+            request_configs,
+            policy=round_policy,
+            quorum=quorum,
+            on_response=on_response,
+            prepare_request=prepare_request,
+            task_timeout=task_timeout,
+            metrics=metrics,
+            idle_timeout=idle_timeout,
+        )
+        self.round = current
 
         try:
-            for device_id in self.available_devices:
-                if self.request_configs:
-                    self.send_task(
-                        device_id=device_id,
-                        request_type=self.request_type,
-                        request_data=self.request_configs[0],
-                    )
-                    self.request_configs.pop(0)
+            if device_ids is not None:
+                await self.send_tasks(
+                    request_type,
+                    [
+                        (device_id, current.partition_request(partition), partition)
+                        for partition, device_id in enumerate(device_ids)
+                    ],
+                )
+            else:
+                current.partition_queue.extend(range(len(current.partition_configs)))
+                self._feed_devices(self.devices.available())
 
-            while not self.timeout and self.task_manager.incomplete_tasks:
-                await asyncio.sleep(0.01)
-                await self._check_task_timeouts()
+            if not current.quorum_reached():
+                # Resolved by the quorum-th completion or by the deadline timer
+                self._arm_deadline(current)
+                self._arm_idle(current)
+                await current.done.wait()
+            current.done.set()
+
+            await self._drain()
+            if current.pending_tasks:
+                if current.timed_out:
+                    # Still pending at the deadline
+                    for task_id in current.pending_tasks:
+                        self._forget_partitions(self.task_manager.tasks[task_id].device_id)
+                    if current.metrics is not None:
+                        current.metrics.expired += len(current.pending_tasks)
+                elif current.metrics is not None:
+                    # No longer needed once the quorum is reached
+                    current.metrics.cancelled += len(current.pending_tasks)
+                await self.cancel_tasks(list(current.pending_tasks))
 
         except Exception as e:
             print(e)
         finally:
-            # Cancel the listening task and disconnect cleanly
-            self.listener.cancel()
+            if owns_session:
+                await self.close()
+            current.close()
+            self.round = None
+        return current
+
+    async def load_available_devices(self) -> List[int]:
+        """
+        Ids of the available devices. They come from the device registry, the
+        devices table is only queried to seed it.
+        """
+        if not self.devices.seeded:
+            await self._seed_devices()
+        return self.devices.available()
 
-    def load_available_devices(self) -> List[int]:
-        "Retrieve devices available at any given point and store them in self.available_devices"
+    async def _seed_devices(self) -> None:
+        """
+        Seed the device registry with the devices seen within its TTL
+        """
+        active_since = datetime.now(timezone.utc) - timedelta(seconds=self.devices.ttl)
         try:
-            response = (
-                supabase.table("devices")
-                .select("id")
-                .eq("status", "available")
-                .gte(
-                    "last_updated",
-                    (datetime.now(timezone.utc) - timedelta(minutes=1)).isoformat(),
-                )
-                .execute()
-            )
-            return [device["id"] for device in response.data]
+            self.devices.seed(await self.backend.available_devices(active_since))
         except Exception as e:
             print("Unable to load devices (unexpected error): ", e)
-            return []
 
-    async def _check_task_timeouts(self):
+    def _check_round(self, current: Round) -> None:
+        """
+        Close a round if it has reached its quorum
+        """
+        if not current.done.is_set() and current.quorum_reached():
+            current.done.set()
+
+    def _forget_tasks(self, task_ids: List[int]) -> None:
+        """
+        Forget tasks locally, so that their late responses are ignored
+        """
+        current = self.round
+        for task_id in task_ids:
+            if current is not None:
+                current.pending_tasks.discard(task_id)
+            if task_id in self.task_manager.tasks:
+                device_id = self.task_manager.tasks[task_id].device_id
+                if current is not None:
+                    current.busy_devices.discard(device_id)
+                if self.tracer is not None:
+                    self.tracer.task_ended(task_id, device_id, "cancelled")
+                self.task_manager.discard_task(task_id)
+
+    async def cancel_tasks(self, task_ids: List[int]) -> None:
         """
-        Checks whether we have hit timeout
+        Cancel tasks whose results are no longer needed: they are forgotten
+        locally so late responses are ignored, and their requests are deleted
+        so that devices that have not picked them up skip them.
         """
-        if self.task_manager.expired_tasks:
-            self.timeout = True
+        self._forget_tasks(task_ids)
+        try:
+            await self.backend.delete_task_requests(task_ids)
+        except Exception as e:
+            print(f"Error cancelling tasks {task_ids}: {e}")
+
+    def _arm_deadline(self, current: Round) -> None:
+        """
+        Start the round's deadline timer when its first task is sent. The round
+        times out once the earliest task has been pending for the deadline.
+        """
+        if current.deadline_timer is None and current.policy.deadline is not None:
+            loop = asyncio.get_running_loop()
+            current.deadline_timer = loop.call_later(
+                current.policy.deadline, self._on_deadline, current
+            )
+
+    def _on_deadline(self, current: Round) -> None:
+        """
+        Deadline timer callback, marks the round as timed out
+        """
+        current.deadline_timer = None
+        if current.pending_partitions or current.partition_queue:
+            current.timed_out = True
+            current.done.set()
+            if self.tracer is not None:
+                self.tracer.instant("deadline", WORKER_TRACK)
+
+    def _arm_idle(self, current: Round) -> None:
+        """
+        Start the round's idle timer, which times it out once no task has
+        completed for its idle timeout
+        """
+        if current.idle_timeout is not None:
+            loop = asyncio.get_running_loop()
+            current.idle_timer = loop.call_at(
+                current.last_response + current.idle_timeout, self._on_idle, current
+            )
+
+    def _on_idle(self, current: Round) -> None:
+        """
+        Idle timer callback, marks the round as timed out if nothing completed
+        since the timer was armed, or arms it again from the last completion
+        """
+        current.idle_timer = None
+        if current.done.is_set():
+            return
+        now = asyncio.get_running_loop().time()
+        if now - current.last_response < current.idle_timeout:
+            self._arm_idle(current)
+            return
+        current.timed_out = True
+        current.done.set()
+        if self.tracer is not None:
+            self.tracer.instant("idle", WORKER_TRACK)
+
+    def _schedule_expiry(self, current: Round) -> None:
+        """
+        Arm the expiry timer for the earliest pending task of a round
+        """
+        expiries = current.task_expiries
+        while expiries and expiries[0][1] not in current.pending_tasks:
+            heapq.heappop(expiries)
+        if current.expiry_timer is not None:
+            current.expiry_timer.cancel()
+            current.expiry_timer = None
+        if expiries and not current.done.is_set():
+            loop = asyncio.get_running_loop()
+            current.expiry_timer = loop.call_at(
+                expiries[0][0], self._expire_tasks, current
+            )
+
+    def _expire_tasks(self, current: Round) -> None:
+        """
+        Expiry timer callback, cancels the tasks that have not answered within
+        the task timeout and queues their partitions again, unless another copy
+        is still pending
+        """
+        current.expiry_timer = None
+        now = asyncio.get_running_loop().time()
+        expired = []
+        while current.task_expiries and current.task_expiries[0][0] <= now:
+            _, task_id = heapq.heappop(current.task_expiries)
+            if task_id in current.pending_tasks:
+                expired.append(task_id)
+        if expired:
+            stalled = {self.task_manager.tasks[task_id].device_id for task_id in expired}
+            for device_id in stalled:
+                self._forget_partitions(device_id)
+            if current.metrics is not None:
+                current.metrics.expired += len(expired)
+            if self.tracer is not None:
+                for task_id in expired:
+                    device_id = self.task_manager.tasks[task_id].device_id
+                    self.tracer.task_ended(task_id, device_id, "expired")
+            self._forget_tasks(expired)
+            self._spawn(self.cancel_tasks(expired))
+            for task_id in expired:
+                partition = current.task_partitions.get(task_id)
+                if partition is None or partition in current.completed_partitions:
+                    continue
+                if not current.partition_tasks[partition] & current.pending_tasks:
+                    current.pending_partitions.discard(partition)
+                    current.partition_queue.append(partition)
+            # Devices that did not answer are offered the partitions last, so
+            # that a silent device is not handed the one it dropped again
+            self._feed_devices(
+                sorted(self.devices.available(), key=lambda device_id: device_id in stalled)
+            )
+        self._schedule_expiry(current)
+
+    def _schedule_backups(self) -> None:
+        """
+        Arm the backup timer of the current round for the moment the oldest
+        pending task that has no backup yet becomes a straggler
+        """
+        current = self.round
+        if current is None:
+            return
+        if current.backup_timer is not None:
+            current.backup_timer.cancel()
+            current.backup_timer = None
+        if not current.policy.backup_tasks or current.done.is_set():
+            return
+        threshold = current.straggler_threshold()
+        started = [
+            current.task_started[task_id]
+            for task_id in current.pending_tasks
+            if current.task_partitions.get(task_id) not in current.backup_partitions
+        ]
+        if threshold is None or not started:
+            return
+        loop = asyncio.get_running_loop()
+        current.backup_timer = loop.call_at(
+            min(started) + threshold, self._send_backups, current
+        )
+
+    def _send_backups(self, current: Round) -> None:
+        """
+        Backup timer callback, sends the partition of every straggling task to
+        an idle device. Partitions get at most one backup.
+        """
+        current.backup_timer = None
+        if current.partition_queue or current.done.is_set():
+            # Idle devices are fed queued partitions first
+            return
+        threshold = current.straggler_threshold()
+        idle_devices = [d for d in self.devices if d not in current.busy_devices]
+        now = asyncio.get_running_loop().time()
+        backups = []
+        reschedule = True
+
+        for task_id in sorted(current.pending_tasks, key=current.task_started.get):
+            partition = current.task_partitions.get(task_id)
+            if partition is None or partition in current.backup_partitions:
+                continue
+            if now - current.task_started[task_id] < threshold:
+                break
+            if not idle_devices:
+                # Rescheduled once a device completes or becomes available
+                reschedule = False
+                break
+            current.backup_partitions.add(partition)
+            backups.append(
+                (idle_devices.pop(0), current.partition_request(partition), partition)
+            )
+
+        if backups:
+            self._reserve(current, backups)
+            self._spawn(self.send_tasks(current.request_type, backups))
+        if reschedule:
+            self._schedule_backups()
+
+    def _feed_devices(self, device_ids: List[int]) -> None:
+        """
+        Send the next queued partitions of the current round to the idle
+        devices among `device_ids`, one each. Partitions that could not be sent
+        are queued again.
+        """
+        current = self.round
+        if current is None or current.done.is_set():
+            return
+        assignments = []
+        for device_id in dict.fromkeys(device_ids):
+            if not current.partition_queue:
+                break
+            if device_id not in current.busy_devices:
+                partition = current.partition_queue.popleft()
+                assignments.append(
+                    (device_id, current.partition_request(partition), partition)
+                )
+        if assignments:
+            self._reserve(current, assignments)
+            self._spawn(
+                self.send_tasks(current.request_type, assignments, requeue=True)
+            )
+
+    def _complete_task(self, current: Round, task_id: int) -> None:
+        """
+        Account for a response of the current round. The first copy of a
+        partition to complete is handed to `on_response` and its other copies
+        are cancelled, later copies are dropped. The device that answered is
+        then fed its next partition.
+        """
+        task = self.task_manager.tasks[task_id]
+        device_id = task.device_id
+        current.pending_tasks.discard(task_id)
+        current.busy_devices.discard(device_id)
+        now = asyncio.get_running_loop().time()
+        latency = now - current.task_started.pop(task_id)
+        current.latencies.append(latency)
+        current.last_response = now
+        if current.request_type == "evaluate":
+            # Evaluation goes through the whole share, unlike training, which
+            # runs `batchSize` steps whatever the size of the share
+            self.device_profiles.record(
+                device_id, task.request_data.datasetsPerDevice or 0, latency
+            )
+        partition = current.task_partitions.get(task_id)
+        if partition is not None:
+            # Tasks sent without a partition have no copies to arbitrate
+            if partition in current.completed_partitions:
+                self.task_manager.discard_task(task_id)
+                self._feed_devices([device_id])
+                return
+            current.completed_partitions.add(partition)
+            current.pending_partitions.discard(partition)
+        if current.metrics is not None:
+            current.metrics.latencies.append(latency)
+            current.metrics.responded_after(
+                asyncio.get_running_loop().time() - current.started
+            )
+
+        copies = set()
+        if partition is not None:
+            copies = current.partition_tasks[partition] & current.pending_tasks
+        if copies:
+            if current.metrics is not None:
+                current.metrics.cancelled += len(copies)
+            self._forget_tasks(list(copies))
+            self._spawn(self.cancel_tasks(list(copies)))
+        if current.on_response is not None:
+            if self.tracer is not None:
+                with self.tracer.span("merge", device_id, task=task_id):
+                    current.on_response(task_id, task)
+            else:
+                current.on_response(task_id, task)
+
+        if current.quorum_reached():
+            current.done.set()
+        else:
+            self._feed_devices([device_id])
+            self._schedule_backups()
 
     def _task_update_callback(self, payload: Dict) -> None:
         """
         Callback to handle responses from the tasks table. Here, we:
 
         - parse the incoming payload
-        - log completion of the task
-        - if there are request_configs remaining (happens when the number of requested configs
-          was higher than the initial number of available devices), we send the device that
-          completed a task its next request config.
+        - log completion of the task, and remember the partition its device holds
+        - hand the first copy of each partition of the current run to the
+          `on_response` hook, if any
+        - if partitions of the current run are still queued, we send the device
+          that completed a task its next partition.
+        """
+        self._handle_response(payload.get("data", {}).get("record"))
+
+    def _handle_response(self, record: Dict) -> None:
+        """
+        Log the response held by a task_responses record
         """
-        record = payload.get("data", {}).get("record")
         task_id = record.get("id")
         if task_id in self.task_manager.tasks:
+            if self.tracer is not None:
+                self.tracer.task_answered(task_id, self.task_manager.tasks[task_id].device_id)
+            decode_started = time.perf_counter()
             self.task_manager.log_completion(
                 task_id=task_id,
-                response_data=ResponseConfig(**record["data"]),
+                response_data=ResponseConfig(
+                    **self.codec.decode_response(record["data"])
+                ),
             )
+            task = self.task_manager.tasks[task_id]
+            if self.tracer is not None:
+                self.tracer.complete("decode", task.device_id, decode_started, task=task_id)
+            current = self.round
+            if current is not None and task_id not in current.pending_tasks:
+                # Late copy, or a task of an earlier round
+                current = None
+            if current is not None and current.metrics is not None:
+                current.metrics.stages["deserialize"] += time.perf_counter() - decode_started
+                current.metrics.received(task.device_id, record["data"])
+            if task.request_data.datasetRef is not None:
+                self.device_partitions[task.device_id].add(task.request_data.datasetRef)
+            if current is not None:
+                self._complete_task(current, task_id)
+        elif self.sends_in_flight:
+            # Its request may still be waiting for the insert to return
+            self.early_responses[task_id] = record
         else:
             print(f"Received task ID not found in my tasks: {task_id}")
 
@@ -263,16 +1166,13 @@ class Worker:
         """
         Callback to handle responses from the devices table. Here, we:
 
-        - extract device ID and new status 
-        - add it to the list of available devices 
+        - extract device ID and new status
+        - apply it to the device registry, and feed a device that has just
+          become available a queued partition of the current run, if any
         """
         record = payload.get("data", {}).get("record")
-        device_id = record.get("id")
-        status = record.get("status")
-        if status == "available" and device_id not in self.available_devices:
-            self.available_devices.append(device_id)
-        elif status == 'unavailable':
-            if device_id in self.available_devices:
-                self.available_devices.remove(device_id)
-            else:
-                print(f"received unavailability update for device id {device_id}??")
\ No newline at end of file
+        if self.tracer is not None and record.get("status") == "busy":
+            self.tracer.device_accepted(record.get("id"))
+        if self.devices.update(record.get("id"), record.get("status")):
+            self._feed_devices([record.get("id")])
+            self._schedule_backups()
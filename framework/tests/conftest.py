@@ -0,0 +1,93 @@
+import asyncio
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+
+import numpy as np
+import pytest
+import tf_keras as keras
+
+from mfl.backend import InMemoryBackend
+from mfl.codec import decode_tensors, is_envelope
+
+
+class ScriptedBackend(InMemoryBackend):
+    """
+    In-memory backend whose devices answer each task after `latency(device_id)`
+    seconds with the weights they were sent plus `step`, and predictions with
+    the inputs they were sent, except the `silent` devices, which never answer
+    """
+
+    def __init__(
+        self,
+        devices: Iterable[int],
+        latency: Callable[[int], float] = lambda device_id: 0.0,
+        silent: Iterable[int] = (),
+        step: float = 0.01,
+    ):
+        super().__init__()
+        self.latency = latency
+        self.silent = set(silent)
+        self.step = step
+        self.inserted: List[Dict] = []
+        for device_id in devices:
+            self.set_device_status(device_id, "available")
+
+    async def insert_task_requests(self, rows: List[Dict]) -> List[Dict]:
+        records = await super().insert_task_requests(rows)
+        loop = asyncio.get_running_loop()
+        for record in records:
+            self.inserted.append(record)
+            if record["device_id"] not in self.silent:
+                loop.call_later(self.latency(record["device_id"]), self._answer, record)
+        return records
+
+    def _answer(self, record: Dict) -> None:
+        if record["id"] not in self.task_requests:
+            # Cancelled before the device picked it up
+            return
+        data = record["data"]
+        weights = data["weights"]
+        if weights is None:
+            weights = self.store.get(data["weightsRef"])
+        if is_envelope(weights):
+            weights = decode_tensors(weights)
+        response = {
+            "weights": [(np.asarray(w, np.float32) + self.step).tolist() for w in weights],
+            "loss": 1.0,
+        }
+        if record["request_type"] == "predict":
+            inputs = data["inputs"]
+            if is_envelope(inputs):
+                inputs = decode_tensors(inputs)[0].tolist()
+            response["outputs"] = inputs
+        self.respond(record["id"], response)
+
+
+def dense_model(units: int = 4) -> keras.Model:
+    model = keras.Sequential(
+        [keras.layers.Input(shape=(units,)), keras.layers.Dense(units)]
+    )
+    model.compile(optimizer="sgd", loss="mean_squared_error")
+    return model
+
+
+@pytest.fixture
+def model() -> keras.Model:
+    return dense_model()
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    inputs = rng.random((48, 4), dtype=np.float32)
+    return inputs, 2 * inputs + 1
+
+
+def weights_delta(before: List[np.ndarray], after: List[np.ndarray]) -> float:
+    return max(float(np.abs(a - b).max()) for a, b in zip(before, after))
+
+
+def run(coroutine, timeout: Optional[float] = 30):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
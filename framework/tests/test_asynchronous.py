@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from conftest import ScriptedBackend, run
+
+from mfl import AsyncPolicy, RoundPolicy, Trainer
+from mfl.asynchronous import AsyncAggregator
+
+
+def test_policy_validates_its_parameters():
+    with pytest.raises(ValueError):
+        AsyncPolicy(buffer_size=0)
+    with pytest.raises(ValueError):
+        AsyncPolicy(staleness="linear")
+
+
+def test_stale_updates_are_discounted():
+    policy = AsyncPolicy(staleness="polynomial", staleness_exponent=1.0)
+    aggregator = AsyncAggregator([np.zeros(2, np.float32)], policy)
+    aggregator.add(0, weights=[np.ones(2)])
+    assert aggregator.version == 1
+    np.testing.assert_allclose(aggregator.weights[0], 1.0)
+
+    # Started from version 0 while version 1 was merged: weighted by 1 / 2
+    aggregator.add(0, weights=[np.full(2, 3.0)])
+    np.testing.assert_allclose(aggregator.weights[0], 2.5)
+
+
+def test_updates_beyond_max_staleness_are_dropped():
+    aggregator = AsyncAggregator([np.zeros(2, np.float32)], AsyncPolicy(max_staleness=0))
+    aggregator.add(0, weights=[np.ones(2)])
+    assert not aggregator.add(0, weights=[np.ones(2)])
+    assert aggregator.num_dropped == 1
+
+
+def test_buffer_merges_every_buffer_size_updates():
+    aggregator = AsyncAggregator([np.zeros(2, np.float32)], AsyncPolicy(buffer_size=3))
+    assert not aggregator.add(0, weights=[np.ones(2)])
+    assert not aggregator.add(0, weights=[np.ones(2)])
+    assert aggregator.add(0, weights=[np.ones(2)])
+    assert aggregator.version == 1 and aggregator.num_merges == 1
+
+
+def test_released_snapshots_keep_live_versions():
+    aggregator = AsyncAggregator([np.zeros(2, np.float32)], AsyncPolicy())
+    for _ in range(3):
+        aggregator.add(aggregator.version, weights=[np.ones(2)])
+    aggregator.release([1])
+    assert set(aggregator.snapshots) == {1, 3}
+
+
+@pytest.mark.parametrize("buffer_size", [1, 4])
+def test_asynchronous_fit(model, data, buffer_size):
+    inputs, outputs = data
+    backend = ScriptedBackend(
+        range(1, 4), latency=lambda device_id: 0.01 * device_id, step=0.1
+    )
+    trainer = Trainer(
+        model,
+        inputs,
+        outputs,
+        batch_size=2,
+        round_policy=RoundPolicy(partitions_per_device=2),
+        async_policy=AsyncPolicy(buffer_size=buffer_size),
+        backend=backend,
+    )
+    before = model.get_weights()
+    trainer.fit(epochs=2)
+
+    # Three devices, two partitions each, queued once per epoch
+    assert len(backend.inserted) == 12
+    versions = [record["data"]["modelVersion"] for record in backend.inserted]
+    assert versions == sorted(versions) and versions[-1] > 0
+    assert trainer.aggregator.version == -(-12 // buffer_size)
+    assert len(trainer.history["train_loss"]) == 2
+    assert all(np.all(new > old) for old, new in zip(before, model.get_weights()))
+    assert not trainer.worker.task_manager.tasks
+
+
+def test_asynchronous_fit_requeues_timed_out_tasks(model, data):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 4), silent=[3])
+    trainer = Trainer(
+        model,
+        inputs,
+        outputs,
+        batch_size=2,
+        round_policy=RoundPolicy(partitions_per_device=2),
+        async_policy=AsyncPolicy(task_timeout=0.2),
+        backend=backend,
+    )
+    trainer.fit(epochs=1)
+
+    answered = [r for r in backend.inserted if r["device_id"] != 3]
+    assert len(answered) == 6
+    assert trainer.telemetry.latest.expired >= 1
+    assert trainer.aggregator.version == 6
+
+
+def test_asynchronous_fit_stops_once_every_device_is_gone(model, data):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 4), silent=[1, 2, 3])
+    trainer = Trainer(
+        model,
+        inputs,
+        outputs,
+        batch_size=2,
+        async_policy=AsyncPolicy(task_timeout=0.1, idle_timeout=0.3),
+        backend=backend,
+    )
+    before = model.get_weights()
+    run(trainer._in_session(trainer._fit(epochs=2), "fit"), timeout=5)
+
+    assert trainer.telemetry.latest.responded == 0
+    assert trainer.aggregator.version == 0
+    assert not trainer.history["train_loss"]
+    assert all(np.all(new == old) for old, new in zip(before, model.get_weights()))
+    assert not trainer.worker.task_manager.tasks
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+
+from mfl.codec import BinaryCodec, JsonCodec, encode_tensors, get_codec, is_envelope
+from mfl.compression import TopKCompressor
+
+
+@pytest.fixture
+def weights():
+    rng = np.random.default_rng(0)
+    return [
+        rng.standard_normal((4, 3)).astype(np.float32),
+        rng.standard_normal(3).astype(np.float32),
+    ]
+
+
+def _through_json(payload):
+    """The payload as the database stores and returns it"""
+    return json.loads(json.dumps(payload))
+
+
+def test_binary_request_uses_envelopes(weights):
+    inputs = np.ones((2, 4), dtype=np.float32)
+    payload = BinaryCodec().encode_request(
+        {"weights": weights, "inputs": inputs, "outputs": None, "batchSize": 2}
+    )
+    assert payload["encoding"] == "binary"
+    assert is_envelope(payload["weights"]) and is_envelope(payload["inputs"])
+    assert payload["outputs"] is None and payload["batchSize"] == 2
+
+
+def test_binary_responses_are_decoded(weights):
+    payload = _through_json(
+        {"weights": encode_tensors(["dense/kernel", "dense/bias"], weights), "loss": 0.5}
+    )
+    fields = BinaryCodec().decode_response(payload)
+    for decoded, original in zip(fields["weights"], weights):
+        assert decoded.dtype == np.float32
+        np.testing.assert_array_equal(decoded, original)
+    assert fields["loss"] == 0.5
+
+
+def test_binary_codec_decodes_json_responses(weights):
+    payload = _through_json({"weights": [w.tolist() for w in weights]})
+    fields = BinaryCodec().decode_response(payload)
+    np.testing.assert_array_equal(fields["weights"][0], weights[0])
+
+
+def test_get_codec_rejects_unknown_codecs():
+    with pytest.raises(ValueError):
+        get_codec("msgpack")
+
+
+def test_quantized_weights_round_trip(weights):
+    names = ["dense/kernel", "dense/bias"]
+    codec = BinaryCodec(weight_names=names, quantization_dtype_map={"uint8": "*/kernel"})
+    envelope = _through_json(codec.encode_request({"weights": weights}))["weights"]
+    manifest = envelope["manifest"]
+    assert "quantization" in manifest[0] and "quantization" not in manifest[1]
+
+    # Devices upload their weights quantized like the ones they were sent
+    kernel, bias = codec.decode_response({"weights": envelope})["weights"]
+    scale = manifest[0]["quantization"]["scale"]
+    np.testing.assert_allclose(kernel, weights[0], atol=scale)
+    np.testing.assert_array_equal(bias, weights[1])
+
+
+def test_get_codec_rejects_quantized_json():
+    with pytest.raises(ValueError):
+        get_codec("json", quantization_dtype_map={"uint8": True})
+
+
+@pytest.mark.parametrize("codec", [JsonCodec(), BinaryCodec()])
+def test_response_round_trip(codec, weights):
+    outputs = [np.arange(6, dtype=np.float32).reshape(2, 3)]
+    payload = _through_json(
+        codec.encode_response({"weights": weights, "outputs": outputs, "loss": 0.5})
+    )
+    fields = codec.decode_response(payload)
+    for decoded, original in zip(fields["weights"], weights):
+        assert decoded.dtype == np.float32
+        np.testing.assert_array_equal(decoded, original)
+    np.testing.assert_array_equal(np.asarray(fields["outputs"][0]), outputs[0])
+    assert fields["loss"] == 0.5
+
+
+@pytest.mark.parametrize("codec", [JsonCodec(), BinaryCodec()])
+def test_sparse_deltas_round_trip(codec, weights):
+    deltas = TopKCompressor(0.5).compress(weights, [np.zeros_like(w) for w in weights])
+    payload = _through_json(codec.encode_response({"deltas": deltas}))
+    fields = codec.decode_response(payload)
+    for decoded, original in zip(fields["deltas"], deltas):
+        np.testing.assert_array_equal(decoded.indices, original.indices)
+        np.testing.assert_array_equal(decoded.values, original.values)
+
+
+def test_encoded_responses_follow_the_request_manifest(weights):
+    names = ["dense/kernel", "dense/bias"]
+    codec = BinaryCodec(weight_names=names, quantization_dtype_map={"uint8": "*/kernel"})
+    manifest = codec.encode_request({"weights": weights})["weights"]["manifest"]
+    payload = _through_json(codec.encode_response({"weights": weights}, manifest=manifest))
+    assert payload["weights"]["manifest"][0]["quantization"]["dtype"] == "uint8"
+
+    kernel, bias = codec.decode_response(payload)["weights"]
+    scale = manifest[0]["quantization"]["scale"]
+    np.testing.assert_allclose(kernel, weights[0], atol=scale)
+    np.testing.assert_array_equal(bias, weights[1])
@@ -0,0 +1,47 @@
+from mfl.devices import DeviceRegistry
+
+
+def test_busy_devices_stay_online_but_not_available():
+    registry = DeviceRegistry()
+    registry.seed([{"id": 1, "last_updated": None}, {"id": 2, "last_updated": None}])
+
+    assert not registry.update(2, "busy")
+    assert registry.available() == [1]
+    assert 2 not in registry and len(registry) == 1
+
+    # Becoming available again counts as joining
+    assert registry.update(2, "available")
+    assert not registry.update(2, "available")
+    assert registry.available() == [1, 2]
+
+
+def test_devices_first_seen_busy_join_once_available():
+    registry = DeviceRegistry()
+    assert not registry.update(3, "busy")
+    assert registry.available() == []
+    assert registry.update(3, "available")
+
+
+def test_unavailable_and_silent_devices_are_dropped():
+    registry = DeviceRegistry(ttl=10)
+    registry.update(1, "available")
+    registry.update(2, "busy")
+    registry.update(1, "unavailable")
+    assert registry.available() == []
+
+    registry.expire(now=registry.last_seen[2] + 11)
+    assert not registry.status
+
+
+def test_devices_going_offline_are_reported():
+    dropped = []
+    registry = DeviceRegistry(ttl=10, on_drop=dropped.append)
+    registry.seed([{"id": 1, "last_updated": None}, {"id": 2, "last_updated": None}])
+    registry.update(3, "busy")
+
+    registry.update(1, "unavailable")
+    registry.update(1, "unavailable")
+    registry.expire(now=registry.last_seen[3] + 11)
+    registry.update(4, "available")
+    registry.seed([{"id": 4, "last_updated": None}])
+    assert dropped == [1, 2, 3]
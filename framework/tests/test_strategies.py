@@ -0,0 +1,11 @@
+import pytest
+
+from mfl.strategies import ServerOptimizer
+
+
+def test_server_optimizers_must_implement_step():
+    class Plain(ServerOptimizer):
+        pass
+
+    with pytest.raises(TypeError):
+        Plain(learning_rate=1.0)
@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+from conftest import ScriptedBackend, run, weights_delta
+
+from mfl import AsyncPolicy, Trainer
+from mfl.backend import InMemoryBackend
+from mfl.simulation import SimulatedBackend
+
+
+def test_fit_on_simulated_devices(model, data):
+    inputs, outputs = data
+    backend = SimulatedBackend(num_devices=3)
+    try:
+        trainer = Trainer(
+            model,
+            inputs,
+            outputs,
+            batch_size=4,
+            validation_inputs=inputs[:12],
+            validation_outputs=outputs[:12],
+            backend=backend,
+        )
+        before = model.get_weights()
+        trainer.fit(epochs=2)
+    finally:
+        backend.shutdown()
+
+    assert len(trainer.history["train_loss"]) == 2
+    assert len(trainer.history["evaluate_loss"]) == 2
+    assert weights_delta(before, model.get_weights()) > 0
+    assert not trainer.worker.task_manager.tasks
+
+
+def test_fit_averages_device_updates(model, data):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 5), step=0.5)
+    trainer = Trainer(model, inputs, outputs, batch_size=2, backend=backend)
+    before = model.get_weights()
+    trainer.fit(epochs=1)
+    for old, new in zip(before, model.get_weights()):
+        np.testing.assert_allclose(new, old + 0.5, atol=1e-6)
+    assert len(backend.inserted) == 4
+
+
+@pytest.mark.parametrize("strategy", [None, "fedavgm", "fedadam"])
+def test_evaluate_and_predict_leave_weights_alone(model, data, strategy):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 4), step=0.5)
+    trainer = Trainer(
+        model,
+        inputs,
+        outputs,
+        batch_size=2,
+        validation_inputs=inputs,
+        validation_outputs=outputs,
+        strategy=strategy,
+        backend=backend,
+    )
+    trainer.fit(epochs=1)
+    after_fit = model.get_weights()
+    trainer.evaluate()
+    trainer.predict(inputs[:6])
+    assert weights_delta(after_fit, model.get_weights()) == 0
+
+
+def test_predict_returns_outputs_in_partition_order(model, data):
+    inputs, outputs = data
+    # Later devices answer first
+    backend = ScriptedBackend(range(1, 5), latency=lambda device_id: 0.05 * (5 - device_id))
+    trainer = Trainer(model, inputs, outputs, batch_size=2, backend=backend)
+    predictions = trainer.predict(inputs[:4])
+    np.testing.assert_allclose(np.concatenate(predictions), inputs[:4])
+
+
+def test_top_k_is_only_requested_for_training(model, data):
+    inputs, outputs = data
+    trainer = Trainer(
+        model, inputs, outputs, batch_size=2, upload_top_k=0.2, backend=InMemoryBackend()
+    )
+    fractions = [
+        run(trainer._create_base_request_config(request_type=request_type)).topKFraction
+        for request_type in ("train", "evaluate", "predict")
+    ]
+    assert fractions == [0.2, None, None]
+
+
+def test_sticky_partitions_are_sent_once(model, data):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 7))
+    trainer = Trainer(
+        model, inputs, outputs, batch_size=2, sticky_partitions=True, backend=backend
+    )
+    trainer.fit(epochs=4)
+    inline = [record["data"]["inputs"] is not None for record in backend.inserted]
+    assert len(inline) == 24
+    assert sum(inline) == 6
+
+
+def test_devices_that_go_offline_are_sent_their_partition_again(model, data):
+    inputs, outputs = data
+    backend = ScriptedBackend(range(1, 7))
+    trainer = Trainer(
+        model, inputs, outputs, batch_size=2, sticky_partitions=True, backend=backend
+    )
+
+    async def fit():
+        async with trainer.worker.session():
+            await trainer._fit(epochs=1)
+            # Device 3 restarts and loses the partitions it cached
+            backend.set_device_status(3, "unavailable")
+            backend.set_device_status(3, "available")
+            await trainer._fit(epochs=1)
+
+    run(fit())
+    inline = [
+        record["device_id"]
+        for record in backend.inserted
+        if record["data"]["inputs"] is not None
+    ]
+    assert sorted(inline) == [1, 2, 3, 3, 4, 5, 6]
+
+
+def test_sticky_partitions_survive_device_reordering(model, data):
+    inputs, outputs = data
+    trainer = Trainer(
+        model, inputs, outputs, batch_size=2, sticky_partitions=True, backend=InMemoryBackend()
+    )
+    first = [device for device, _, _ in trainer._split(inputs, [1, 2, 3], outputs)]
+    again = [device for device, _, _ in trainer._split(inputs, [3, 1, 2], outputs)]
+    replaced = [device for device, _, _ in trainer._split(inputs, [4, 3, 1], outputs)]
+    assert again == first
+    assert replaced == [1, 4, 3]
+
+
+def test_asynchronous_training_rejects_other_strategies(model, data):
+    inputs, outputs = data
+    with pytest.raises(ValueError):
+        Trainer(
+            model,
+            inputs,
+            outputs,
+            batch_size=2,
+            strategy="fedadam",
+            async_policy=AsyncPolicy(),
+            backend=InMemoryBackend(),
+        )
+    with pytest.raises(ValueError):
+        Trainer(
+            model,
+            inputs,
+            outputs,
+            batch_size=2,
+            share_weights=True,
+            async_policy=AsyncPolicy(),
+            backend=InMemoryBackend(),
+        )
@@ -0,0 +1,182 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from conftest import ScriptedBackend, run
+
+from mfl import RoundPolicy, Trainer
+from mfl.worker import (
+    TASK_TIMEOUT,
+    RequestConfig,
+    ResponseConfig,
+    Round,
+    TaskManager,
+    Worker,
+)
+
+SLOW = 5.0  # seconds, longer than any test waits
+
+
+def _trainer(model, data, backend, **kwargs):
+    inputs, outputs = data
+    return Trainer(model, inputs, outputs, batch_size=2, backend=backend, **kwargs)
+
+
+def test_quorum_closes_over_provisioned_round(model, data):
+    backend = ScriptedBackend(
+        range(1, 9), latency=lambda device_id: SLOW if device_id > 6 else 0.01
+    )
+    trainer = _trainer(
+        model,
+        data,
+        backend,
+        round_policy=RoundPolicy(devices_per_round=6, over_provision=2),
+    )
+    started = time.monotonic()
+    trainer.fit(epochs=1)
+
+    assert time.monotonic() - started < SLOW
+    metrics = trainer.telemetry.latest
+    assert (metrics.dispatched, metrics.responded) == (8, 6)
+    assert (metrics.cancelled, metrics.expired) == (2, 0)
+    # The requests of the cancelled tasks are deleted
+    assert len(backend.task_requests) == 6
+    assert not trainer.worker.task_manager.tasks
+
+
+def test_deadline_expires_silent_devices(model, data):
+    backend = ScriptedBackend(range(1, 5), silent=[4])
+    trainer = _trainer(model, data, backend, round_policy=RoundPolicy(deadline=0.2))
+    trainer.fit(epochs=1)
+
+    metrics = trainer.telemetry.latest
+    assert (metrics.responded, metrics.expired, metrics.cancelled) == (3, 1, 0)
+    assert len(trainer.history["train_loss"]) == 1
+
+
+def test_backup_tasks_replace_stragglers(model, data):
+    # Device 4 straggles, its partition is sent again to a device that is done
+    backend = ScriptedBackend(
+        range(1, 5), latency=lambda device_id: SLOW if device_id == 4 else 0.02
+    )
+    trainer = _trainer(
+        model,
+        data,
+        backend,
+        round_policy=RoundPolicy(backup_tasks=True, straggler_factor=2.0),
+    )
+    datasets = trainer._split(trainer.inputs, [1, 2, 3, 4], trainer.outputs)
+
+    async def dispatch():
+        async with trainer.worker.session():
+            config = await trainer._create_base_request_config()
+            await trainer._dispatch(config, datasets, "train")
+
+    started = time.monotonic()
+    run(dispatch())
+
+    assert time.monotonic() - started < SLOW
+    assert len(backend.inserted) == 5
+    backup = backend.inserted[-1]
+    assert backup["device_id"] != 4
+    assert backup["data"]["inputs"] == backend.inserted[3]["data"]["inputs"]
+    completed = trainer.worker.task_manager.completed_tasks.values()
+    assert sorted(task.partition for task in completed) == [0, 1, 2, 3]
+    # The straggling copy is cancelled
+    assert backend.inserted[3]["id"] not in backend.task_requests
+
+
+def test_partitions_are_pulled_by_idle_devices(model, data):
+    backend = ScriptedBackend([1, 2], latency=lambda device_id: 0.01 if device_id == 1 else 0.05)
+    trainer = _trainer(model, data, backend, round_policy=RoundPolicy(partitions_per_device=3))
+    trainer.fit(epochs=1)
+
+    devices = Counter(record["device_id"] for record in backend.inserted)
+    assert sum(devices.values()) == 6
+    assert devices[1] > devices[2]
+    assert trainer.telemetry.latest.responded == 6
+    assert trainer.worker.round is None
+
+
+def test_devices_busy_with_another_job_are_not_sent_tasks(model, data):
+    backend = ScriptedBackend(range(1, 5))
+    trainer = _trainer(model, data, backend)
+
+    async def fit():
+        async with trainer.worker.session():
+            # Device 4 starts a task of another consumer once the session is open
+            backend.set_device_status(4, "busy")
+            await trainer._fit(epochs=1)
+
+    run(fit())
+    assert {record["device_id"] for record in backend.inserted} == {1, 2, 3}
+
+
+def test_tasks_without_partition_all_reach_on_response():
+    backend = ScriptedBackend([1, 2, 3])
+    worker = Worker(1, backend=backend)
+    responses = []
+
+    async def send():
+        async with worker.session():
+            worker.round = Round(
+                "evaluate", [], on_response=lambda task_id, task: responses.append(task_id)
+            )
+            for device_id in (1, 2, 3):
+                config = RequestConfig(modelJson="{}", weights=[], batchSize=1)
+                assert await worker.send_task(device_id, "evaluate", config)
+            await asyncio.sleep(0.05)
+
+    run(send())
+    assert sorted(responses) == [1, 2, 3]
+
+
+def test_throughput_is_measured_from_evaluation_rounds(model, data):
+    # Both devices evaluate 500 samples per second, on shares of 40 and 8
+    backend = ScriptedBackend([1, 2], latency=lambda device_id: 0.08 if device_id == 1 else 0.016)
+    trainer = _trainer(model, data, backend)
+    inputs, outputs = data
+    datasets = [(1, inputs[:40], outputs[:40]), (2, inputs[40:], outputs[40:])]
+
+    async def dispatch(request_type):
+        async with trainer.worker.session():
+            config = await trainer._create_base_request_config(request_type=request_type)
+            await trainer._dispatch(config, datasets, request_type)
+
+    profiles = trainer.worker.device_profiles
+    run(dispatch("train"))
+    assert 1 not in profiles and 2 not in profiles
+    run(dispatch("evaluate"))
+    assert abs(profiles.throughput(1) / profiles.throughput(2) - 1) < 0.5
+
+
+def test_only_evaluation_shares_are_capacity_weighted(model, data):
+    trainer = _trainer(
+        model, data, ScriptedBackend([1, 2]), round_policy=RoundPolicy(capacity_weighted=True)
+    )
+    trainer.worker.device_profiles.record(1, 300, 1.0)
+    trainer.worker.device_profiles.record(2, 100, 1.0)
+    inputs, outputs = data
+
+    def shares(request_type):
+        datasets = trainer._split(inputs, [1, 2], outputs, request_type=request_type)
+        return [len(device_inputs) for _, device_inputs, _ in datasets]
+
+    assert shares("train") == [24, 24]
+    assert shares("evaluate") == [36, 12]
+
+
+def test_task_manager_forgets_discarded_tasks():
+    manager = TaskManager()
+    config = RequestConfig(modelJson="{}", weights=[], batchSize=1)
+    sent_at = datetime.now(timezone.utc) - timedelta(seconds=TASK_TIMEOUT + 1)
+    for task_id in range(100):
+        manager.create_task(task_id, config, sent_at, device_id=1)
+    manager.log_completion(0, ResponseConfig(loss=1.0))
+
+    assert set(manager.completed_tasks) == {0}
+    assert len(manager.expired_tasks) == 99
+    for task_id in range(100):
+        manager.discard_task(task_id)
+    assert not manager.tasks and not manager.pending and not manager.completed